@@ -341,6 +341,8 @@ def main():
                 st.info("Enter your OpenAI API key above to get started.")
                 st.stop()
             st.success("✅ API Key accepted")
+        # Connect to OpenAI in the background while the user picks images
+        app_graph.warm_up(api_key)
 
         st.markdown('<div class="section-label">AI Models</div>', unsafe_allow_html=True)
         ocr_model = st.selectbox(
@@ -596,6 +598,12 @@ def process_documents(uploaded_files, ocr_model, extraction_model, pharmacy_mode
                 with st.expander("📄 OCR Results"):
                     st.markdown(markdown)
             
+            # Diagnoses and medications only need the OCR text, so extract them concurrently;
+            # the step 2 and 3 calls below then return the cached results
+            if run_diagnoses and run_medications:
+                with st.spinner("Extracting diagnoses and medications..."):
+                    app_graph.run_extractions(model=extraction_model, api_key=api_key)
+            
             # Step 2: Extract Diagnoses (Optional)
             if run_diagnoses:
                 step_msg = "🩺 Step 2/5: Extracting diagnoses..."
@@ -854,8 +862,8 @@ def display_results():
             # ── Medications ───────────────────────────────────────────────
             elif tab_type == "medications":
                 meds = results['medications'].get('medications', [])
-                with_dur = len([m for m in meds if m.get('duration','').lower() not in ['','continue','as needed']])
-                as_needed = len([m for m in meds if 'as needed' in m.get('duration','').lower()])
+                with_dur = sum(1 for m in meds if m.get('duration','').lower() not in ('','continue','as needed'))
+                as_needed = sum(1 for m in meds if 'as needed' in m.get('duration','').lower())
 
                 c1, c2, c3 = st.columns(3)
                 c1.metric("💊 Medications", len(meds))
@@ -882,9 +890,11 @@ def display_results():
             elif tab_type == "medication_links":
                 fixed = results['fixed_medications']
                 fixed_list = fixed.get('medications', [])
-                hi   = len([m for m in fixed_list if m.get('selection_confidence', 0) > 80])
-                lnks = len([m for m in fixed_list if m.get('pharmaeasy_url')])
-                none = len([m for m in fixed_list if not m.get('all_products')])
+                hi = lnks = none = 0
+                for m in fixed_list:
+                    hi   += m.get('selection_confidence', 0) > 80
+                    lnks += bool(m.get('pharmaeasy_url'))
+                    none += not m.get('all_products')
 
                 c1, c2, c3, c4 = st.columns(4)
                 c1.metric("💊 Total",         len(fixed_list))
@@ -947,10 +957,10 @@ def create_download_zip(results):
             zip_file.writestr("discharge.md", results['markdown'])
         
         # Add JSON files for available data
-        import json
+        import orjson
         for key in ['diagnoses', 'medications', 'fixed_medications']:
             if key in results and results[key] is not None:
-                zip_file.writestr(f"{key}.json", json.dumps(results[key], indent=2))
+                zip_file.writestr(f"{key}.json", orjson.dumps(results[key], option=orjson.OPT_INDENT_2))
         
         # Add a summary of what was processed
         summary_text = "Shusrusha Processing Summary\n" + "="*30 + "\n\n"
@@ -1,16 +1,69 @@
 from langgraph.graph import StateGraph
-from typing import TypedDict, List, Dict, Any
+from typing import TypedDict, List, Dict, Any, Optional, Tuple, Iterator
 import openai
 import base64
 import os
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 from urllib.parse import quote
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from html import escape
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 import threading
+import asyncio
 import time
 import random
+import functools
+import hashlib
+import heapq
+import operator
+import io
+import copy
+import sqlite3
+import unicodedata
+from collections import OrderedDict, deque
+from bs4 import BeautifulSoup
+import difflib
+
+# Optional C-accelerated fuzzy matching; difflib is used when rapidfuzz is not installed
+try:
+    from rapidfuzz import fuzz as rapidfuzz_fuzz
+except ImportError:
+    rapidfuzz_fuzz = None
+
+# Optional compiled markdown parser; the regex converter below is used when mistune is not installed
+try:
+    import mistune
+    _markdown_renderer = mistune.create_markdown(escape=False, plugins=['strikethrough', 'table'])
+except ImportError:
+    _markdown_renderer = None
+
+# Pillow is used to shrink page images before OCR upload; raw bytes are sent when it is missing
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Precompiled regex patterns used on hot paths
+_MD_H1 = re.compile(r'^# (.+)$', re.MULTILINE)
+_MD_H2 = re.compile(r'^## (.+)$', re.MULTILINE)
+_MD_H3 = re.compile(r'^### (.+)$', re.MULTILINE)
+_MD_BOLD = re.compile(r'\*\*(.+?)\*\*')
+_MD_ITALIC = re.compile(r'\*(.+?)\*')
+_PARA = re.compile(r'\n\n+')
+_EMPTY_P = re.compile(r'<p>\s*</p>')
+_STRENGTH_WITH_UNIT = re.compile(r'(\d+(?:\.\d+)?)\s*(?:mg|ml|g|mcg|units?|iu)', re.IGNORECASE)
+_STRENGTH_NUM = re.compile(r'(\d+\.?\d*)')
+_NEXT_DATA_SCRIPT = re.compile(r'<script[^>]*\bid=["\']__NEXT_DATA__["\'][^>]*>')
+_PRODUCT_NAME_SLUG = re.compile(r'{[^}]*"name"\s*:\s*"([^"]*)"[^}]*"slug"\s*:\s*"([^"]*)"[^}]*}')
+_OCR_MEDICATION = re.compile(r'\b(tab|cap|syp|syr|inj)\.?\s+([a-z][a-z-]+(?:\s+[a-z][a-z-]+)?)(?:\s+(\d+(?:\.\d+)?)\s*(?:mg|ml|mcg|g|iu)?\b)?', re.IGNORECASE)
+_ADJACENT_MEDICATION_LISTS = re.compile(r'</ul>\s*<ul class="medication-list">')
+_HTML_TAG = re.compile(r'(<[^>]*>)')
+
+# Deletion table for name normalization: every byte that is not an ASCII letter
+_NON_ALPHA_BYTES = bytes(c for c in range(256) if not (65 <= c <= 90 or 97 <= c <= 122))
 
 # Define the state structure
 class GraphState(TypedDict):
@@ -23,61 +76,393 @@ class GraphState(TypedDict):
 
 # Thread-safe rate limiter for API calls
 class RateLimiter:
-    def __init__(self, max_calls_per_second=2):
+    def __init__(self, max_calls_per_second=2, max_rate=None, min_rate=0.2):
         self.max_calls_per_second = max_calls_per_second
         self.min_interval = 1.0 / max_calls_per_second
-        self.last_call_time = 0
+        self.max_rate = max_rate or max_calls_per_second
+        self.min_rate = min_rate
+        self.next_call_time = 0.0
         self.lock = threading.Lock()
     
     def wait_if_needed(self):
+        # Reserve the next slot under the lock, then sleep outside it so waiting
+        # threads don't serialize on the lock; monotonic time ignores clock adjustments
+        with self.lock:
+            current_time = time.monotonic()
+            call_time = max(current_time, self.next_call_time)
+            self.next_call_time = call_time + self.min_interval
+        sleep_time = call_time - current_time
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+    
+    def on_success(self):
+        """Additive increase: creep the rate back up after a successful call."""
+        with self.lock:
+            self.max_calls_per_second = min(self.max_rate, self.max_calls_per_second + 0.05)
+            self.min_interval = 1.0 / self.max_calls_per_second
+    
+    def on_throttle(self):
+        """Multiplicative decrease: halve the rate when the server pushes back (429/403)."""
+        with self.lock:
+            self.max_calls_per_second = max(self.min_rate, self.max_calls_per_second * 0.5)
+            self.min_interval = 1.0 / self.max_calls_per_second
+
+# Thread-safe LRU cache with per-entry expiry
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+    
+    def clear(self):
         with self.lock:
-            current_time = time.time()
-            time_since_last_call = current_time - self.last_call_time
-            if time_since_last_call < self.min_interval:
-                sleep_time = self.min_interval - time_since_last_call
-                time.sleep(sleep_time)
-            self.last_call_time = time.time()
+            self.data.clear()
+
+# SQLite-backed key/value cache so expensive results survive app restarts
+class SQLiteCache:
+    def __init__(self, path, table, ttl=None):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.connection = None
+        self.lock = threading.Lock()
+    
+    def connect(self):
+        # Opened lazily so importing the module doesn't create the database file
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT, ts INTEGER)"
+            )
+            # Expired rows are deleted, not just ignored, so old entries don't stay on disk
+            if self.ttl is not None:
+                self.connection.execute(f"DELETE FROM {self.table} WHERE ts < ?", (int(time.time() - self.ttl),))
+            self.connection.commit()
+        return self.connection
+    
+    def get(self, key):
+        try:
+            with self.lock:
+                row = self.connect().execute(
+                    f"SELECT value, ts FROM {self.table} WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Warning: {self.table} disk cache read failed: {e}")
+            return None
+        if row is None or (self.ttl is not None and row[1] + self.ttl < time.time()):
+            return None
+        return row[0]
+    
+    def set(self, key, value):
+        try:
+            with self.lock:
+                connection = self.connect()
+                connection.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (key, value, ts) VALUES (?, ?, ?)",
+                    (key, value, int(time.time()))
+                )
+                connection.commit()
+        except sqlite3.Error as e:
+            print(f"Warning: {self.table} disk cache write failed: {e}")
+
+def make_cache_key(*parts) -> bytes:
+    """
+    Build a compact, stable cache key from JSON-serializable parts.
+    """
+    return hashlib.blake2b(orjson.dumps(parts, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
+# Caches so re-running the graph on the same document skips repeated work
+selection_cache = TTLCache(maxsize=4096, ttl=600)
+# Raw search pages are a few hundred KB each, and parsed products are cached separately, so only
+# enough pages are kept to hand the OCR-time prefetches (OCR_PREFETCH_LIMIT per document) to the lookups
+pharmeasy_content_cache = TTLCache(maxsize=32, ttl=600)
+# Searches that found no products are only remembered briefly, in memory
+pharmeasy_no_products_cache = TTLCache(maxsize=512, ttl=600)
+chat_completion_cache = TTLCache(maxsize=256, ttl=3600)
+# Downscaled, base64-encoded OCR pages keyed by the sha256 of the original file bytes
+encoded_image_cache = TTLCache(maxsize=32, ttl=3600)
+
+# On-disk caches live in one SQLite file; PharmeEasy listings change slowly, so products are kept for a week
+CACHE_DB_PATH = os.getenv("SHUSRUSHA_CACHE_DB", "shusrusha_cache.db")
+pharmeasy_products_disk_cache = SQLiteCache(CACHE_DB_PATH, "pharmeasy_products", ttl=7 * 24 * 3600)
+
+# OCR transcripts contain patient details, so they are kept for a day and can be kept off disk
+# entirely with SHUSRUSHA_PERSIST_OCR=0
+PERSIST_OCR_RESULTS = os.getenv("SHUSRUSHA_PERSIST_OCR", "1") != "0"
+OCR_DISK_CACHE_TTL = int(os.getenv("SHUSRUSHA_OCR_CACHE_TTL", str(24 * 3600)))
+
+# Browser-like headers sent with every PharmeEasy request
+PHARMEASY_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'Cache-Control': 'no-cache',
+    'Pragma': 'no-cache'
+}
+
+# One keep-alive session per worker thread; requests.Session isn't guaranteed thread-safe
+pharmeasy_sessions = threading.local()
+
+def get_pharmeasy_session() -> requests.Session:
+    """
+    Return this thread's PharmeEasy session, creating it on first use.
+    """
+    session = getattr(pharmeasy_sessions, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update(PHARMEASY_HEADERS)
+        # 429/403 are handled in fetch_pharmeasy_content; only transient 5xx are retried here
+        session.mount('https://', HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=2,
+            max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504], allowed_methods=["GET"])
+        ))
+        pharmeasy_sessions.session = session
+    return session
 
 # Global rate limiters
-pharmeasy_rate_limiter = RateLimiter(max_calls_per_second=1)  # Very conservative for web scraping
-openai_rate_limiter = RateLimiter(max_calls_per_second=10)    # OpenAI can handle more
+pharmeasy_rate_limiter = RateLimiter(max_calls_per_second=1, max_rate=2)  # Conservative for web scraping, adapts to 429/403 feedback
+openai_rate_limiter = RateLimiter(max_calls_per_second=10)    # OpenAI can handle more; static, since every API key shares it
+
+@functools.lru_cache(maxsize=4)
+def get_openai_client(api_key: str = None) -> openai.OpenAI:
+    """
+    Return a shared OpenAI client per API key so HTTPS connections are reused across calls.
+    """
+    # Retries are handled by create_chat_completion so they share the rate limiter's backoff
+    return openai.OpenAI(api_key=api_key or os.getenv('OPENAI_API_KEY'), max_retries=0)
+
+# Transient OpenAI failures worth retrying instead of failing the whole node
+RETRYABLE_OPENAI_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+def openai_retry_after(error: Exception) -> Optional[float]:
+    """
+    Seconds to wait from the error response's Retry-After header, or None if absent or not a number.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def create_chat_completion(client: openai.OpenAI, api_params: dict, max_attempts: int = 5, use_cache: bool = True):
+    """
+    Call chat.completions.create through the shared OpenAI rate limiter, retrying transient
+    errors (429, connection drops, 5xx) after the server's Retry-After, or else with
+    exponential backoff and jitter. An exhausted quota is raised straight away.
+    Identical requests (same model, messages and parameters) are answered from
+    chat_completion_cache, so re-processing a document skips the API call.
+    Calls made by AppGraph nodes pass use_cache=False: AppGraph.cache already covers them,
+    and its cache=False bypass must reach the API.
+    """
+    cache_key = make_cache_key(client.api_key, api_params) if use_cache else None
+    if cache_key is not None:
+        cached_response = chat_completion_cache.get(cache_key)
+        if cached_response is not None:
+            print(f"Using cached OpenAI response (Model: {api_params.get('model')})")
+            return cached_response
+    
+    for attempt in range(max_attempts):
+        openai_rate_limiter.wait_if_needed()
+        try:
+            response = client.chat.completions.create(**api_params)
+            # Truncated or filtered completions are not cached so they are retried next time
+            if cache_key is not None and response.choices and response.choices[0].finish_reason == "stop":
+                chat_completion_cache.set(cache_key, response)
+            return response
+        except RETRYABLE_OPENAI_ERRORS as e:
+            # An exhausted quota is a 429 too, but waiting won't fix it
+            if attempt == max_attempts - 1 or getattr(e, "code", None) == "insufficient_quota":
+                raise
+            retry_after = openai_retry_after(e)
+            delay = retry_after if retry_after is not None else 2 ** attempt + random.random()
+            print(f"OpenAI call failed ({type(e).__name__}), retrying in {delay:.1f}s (attempt {attempt + 1})")
+            time.sleep(delay)
+
+# Structured-output schema for product listings parsed from PharmeEasy pages
+PRODUCT_LISTINGS_SCHEMA = {
+    "name": "product_listings",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "products": {
+                "type": "array",
+                "description": "Up to 10 product listings from the search results",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"type": "string", "description": "Product name/title"},
+                        "url": {"type": "string", "description": "Product URL, prefixed with https://pharmeasy.in if relative"}
+                    },
+                    "required": ["name", "url"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["products"],
+        "additionalProperties": False
+    }
+}
+
+# Structured-output schemas for the extraction nodes, so the parsed JSON always has the expected shape
+DIAGNOSES_SCHEMA = {
+    "name": "diagnoses",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "diagnoses": {"type": "array", "items": {"type": "string"}},
+            "lab_tests": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["diagnoses", "lab_tests"],
+        "additionalProperties": False
+    }
+}
+
+MEDICATIONS_SCHEMA = {
+    "name": "medications",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "medications": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"type": "string", "description": "Medicine name only, without strength or form"},
+                        "form": {"type": "string"},
+                        "strength": {"type": "string"},
+                        "instructions": {"type": "string"},
+                        "duration": {"type": "string"}
+                    },
+                    "required": ["name", "form", "strength", "instructions", "duration"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["medications"],
+        "additionalProperties": False
+    }
+}
+
+# Combined schema for extracting diagnoses, lab tests and medications in one call
+ENTITIES_SCHEMA = {
+    "name": "entities",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            **DIAGNOSES_SCHEMA["schema"]["properties"],
+            **MEDICATIONS_SCHEMA["schema"]["properties"]
+        },
+        "required": ["diagnoses", "lab_tests", "medications"],
+        "additionalProperties": False
+    }
+}
+
+HTML_PARSING_PROMPT = """You are an expert web scraper. Parse this HTML content from Pharmeasy.in search results.
+
+Look for product listings in the main body of the page and extract up to 10 products. For each product, extract:
+- name: The product name/title
+- url: The product URL (if relative path, prepend "https://pharmeasy.in")
+
+Look for patterns like:
+- Product cards or containers
+- Links to product pages (often containing "/online-medicine-order/" or "/medicines/")
+- Product names in headings, spans, or divs
+- Medicine names and dosages
+- JSON data containing product information
+
+Return JSON format:
+{"products": [{"name": "Product Name 1", "url": "https://pharmeasy.in/online-medicine-order/..."}, {"name": "Product Name 2", "url": "https://pharmeasy.in/..."}, ...]}
+
+If no products found, return empty products array."""
 
-def get_openai_params(model: str, messages: list, max_tokens: int = 2048, temperature: float = 0.1, use_json_format: bool = True) -> dict:
+@functools.lru_cache(maxsize=64)
+def model_family(model: str) -> str:
+    """
+    Parameter family of a model name: "gpt-5", "o1", "o3", or "gpt-4" for everything older.
+    """
+    for prefix in ("gpt-5", "o1", "o3"):
+        if model.startswith(prefix):
+            return prefix
+    return "gpt-4"
+
+@functools.lru_cache(maxsize=64)
+def supports_json_schema(model: str) -> bool:
+    """
+    Whether the model accepts response_format={"type": "json_schema"} (structured outputs).
+    """
+    return model.startswith("gpt-5") or model.startswith("gpt-4o") or model.startswith("gpt-4.1")
+
+def get_openai_params(model: str, messages: list, max_tokens: int = 2048, temperature: float = 0.1, use_json_format: bool = True, json_schema: dict = None) -> dict:
     """
     Get the correct OpenAI API parameters based on the model type.
+    If json_schema is given and the model supports structured outputs, the response
+    is constrained to that schema; otherwise plain JSON mode is used.
     """
     base_params = {
         "model": model,
         "messages": messages
     }
     
+    if not use_json_format:
+        response_format = None
+    elif json_schema and supports_json_schema(model):
+        response_format = {"type": "json_schema", "json_schema": json_schema}
+    else:
+        response_format = {"type": "json_object"}
+    
     # Handle different model families
-    if model.startswith("gpt-5") or model.startswith("o1") or model.startswith("o3"):
-        # For GPT-5, o1, and o3 models, use max_completion_tokens
+    family = model_family(model)
+    if family in ("o1", "o3"):
+        # o1 and o3 models use max_completion_tokens and don't support response_format, temperature
         base_params["max_completion_tokens"] = max_tokens
-        
-        # o1 and o3 models don't support response_format, temperature
-        if model.startswith("o1") or model.startswith("o3"):
-            pass  # No additional params for o1/o3
-        elif model.startswith("gpt-5"):
-            # GPT-5 models: only support temperature=1 (default)
-            base_params["temperature"] = 1
-            if use_json_format:
-                base_params["response_format"] = {"type": "json_object"}
+    elif family == "gpt-5":
+        # GPT-5 models use max_completion_tokens and only support temperature=1 (default)
+        base_params["max_completion_tokens"] = max_tokens
+        base_params["temperature"] = 1
+        if use_json_format:
+            base_params["response_format"] = response_format
     else:
         # For GPT-4 and older models, use max_tokens
         base_params["max_tokens"] = max_tokens
         base_params["temperature"] = temperature
         if use_json_format:
-            base_params["response_format"] = {"type": "json_object"}
+            base_params["response_format"] = response_format
     
     return base_params
 
-def ocr_node(state: GraphState, model: str = "gpt-5.4", api_key: str = None) -> GraphState:
-    """
-    Process images and extract text using GPT-4 Vision.
-    """
-    system_prompt = """Task. You are an expert medical assistant working in a hospital located 
+# Node system prompts are module constants so every call sends an identical prefix,
+# which lets OpenAI's automatic prompt caching reuse it across documents
+OCR_SYSTEM_PROMPT = """Task. You are an expert medical assistant working in a hospital located 
     in Kolkata, India. Transcribe this discharge summary issued to a patient exactly 
     (i.e. preserve all sections/headers/order/ and all written text). If in doubt about some unclear writing,
       try to match with terms that make sense in an India context, for medical field and 
@@ -86,45 +471,194 @@ def ocr_node(state: GraphState, model: str = "gpt-5.4", api_key: str = None) ->
       has many more and different characters). Then output a 
       simple markdown document with all the contents with the same content as the original. For 
       prescribed medications, "Tab" is often written to look like "76" """
+
+DIAGNOSES_SYSTEM_PROMPT = """You are an expert medical doctor practising in Kolkata India. You have been given a hospital discharge report of a patient in simple mardown text format. Your job is to identify all the relevant medical terms in the document related to a) diagnosis names b) lab test names from the document. Ignore all medicine names. Keep in mind common terminology used in that part of the world. Return a JSON structure of the form
+{"diagnoses": ["diagnosis term 1", "diagnosis term 2", ...], "lab_tests":["lab test name 1", "lab test name 2", ...]}"""
+
+MEDICATIONS_SYSTEM_PROMPT = """You are an expert medical doctor practising in Kolkata India. You have been given a hospital discharge report of a patient in simple mardown text format. Your job is to identify all the relevant medications from the document along with instructions. In case of difficulty identifying a medication, make sure the names match actual medications used in that part of the world. Return a JSON structure of the form
+{"medications": [{"name":"paracetamol xr", "form":"tablet", "strength":"5 mg", "instructions":"Twice daily", "duration":"continue"}, {"name":"atorvastatin", "form":"syrup", "strength":"10 ml", "instructions":"as needed", "duration":"as needed"}, {"name":"medicine_3", "form":"powder", "strength":"1 pouch", "instructions":"BID", "duration":"10 days"}]}.
+The "name" fields should only contain the medicine name e.g. "Rantac XR")
+and not contain other information like its strength or form factor (tab/table, cap/capsure, 
+syr/syrup, pdr/powder etc.). Finally append a small description to the instructions if they
+are not easily understandable by a layman"""
+
+ENTITIES_SYSTEM_PROMPT = """You are an expert medical doctor practising in Kolkata India. You have been given a hospital discharge report of a patient in simple mardown text format. Your job is to identify a) all diagnosis names, b) all lab test names and c) all medications with their instructions. Keep in mind common terminology used in that part of the world, and in case of difficulty identifying a medication, make sure the names match actual medications used there. Return a JSON structure of the form
+{"diagnoses": ["diagnosis term 1", ...], "lab_tests": ["lab test name 1", ...], "medications": [{"name":"paracetamol xr", "form":"tablet", "strength":"5 mg", "instructions":"Twice daily", "duration":"continue"}, {"name":"medicine_2", "form":"powder", "strength":"1 pouch", "instructions":"BID", "duration":"10 days"}]}.
+Diagnoses and lab tests must not include medicine names. The medication "name" fields should only contain the medicine name e.g. "Rantac XR")
+and not contain other information like its strength or form factor (tab/table, cap/capsure, 
+syr/syrup, pdr/powder etc.). Finally append a small description to the instructions if they
+are not easily understandable by a layman"""
+
+# Limits for sending all pages in one vision request; larger uploads are split into batches
+OCR_MAX_IMAGES_PER_REQUEST = 10
+OCR_MAX_PAYLOAD_BYTES = 20 * 1024 * 1024
+
+# Long edge and JPEG quality used when shrinking page images before upload
+OCR_MAX_IMAGE_EDGE = 2048
+OCR_JPEG_QUALITY = 85
+
+def encode_image_for_ocr(image_path: str) -> Optional[Tuple[str, str]]:
+    """
+    Return (mime type, base64 data) for an OCR page, or None if the file is missing.
+    Large pages are downscaled to the vision model's working resolution and re-encoded as JPEG.
+    """
+    try:
+        with open(image_path, "rb") as image_file:
+            raw_bytes = image_file.read()
+    except FileNotFoundError:
+        return None
     
-    client = openai.OpenAI(api_key=api_key or os.getenv('OPENAI_API_KEY'))
+    # The same page uploaded again (or OCR'd with another model) reuses the earlier encoding
+    raw_digest = hashlib.sha256(raw_bytes).digest()
+    cached = encoded_image_cache.get(raw_digest)
+    if cached is not None:
+        return cached
     
-    # Process images
-    image_contents = []
-    for image_path in state.get("images", []):
+    image_type = "image/jpeg" if image_path.lower().endswith(('.jpg', '.jpeg')) else "image/png"
+    
+    if Image is not None:
         try:
-            with open(image_path, "rb") as image_file:
-                image_data = base64.b64encode(image_file.read()).decode('utf-8')
-                
-            image_type = "image/jpeg" if image_path.lower().endswith(('.jpg', '.jpeg')) else "image/png"
-            
-            image_contents.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{image_type};base64,{image_data}"
-                }
-            })
-        except FileNotFoundError:
+            with Image.open(io.BytesIO(raw_bytes)) as image:
+                if max(image.size) > OCR_MAX_IMAGE_EDGE or len(raw_bytes) > 1024 * 1024:
+                    # Re-encoding drops the EXIF Orientation tag, so rotate phone photos upright first
+                    image = ImageOps.exif_transpose(image)
+                    image.thumbnail((OCR_MAX_IMAGE_EDGE, OCR_MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+                    buffer = io.BytesIO()
+                    image.convert("RGB").save(buffer, "JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+                    # Keep the original if re-encoding didn't actually make it smaller
+                    if buffer.tell() < len(raw_bytes):
+                        raw_bytes = buffer.getvalue()
+                        image_type = "image/jpeg"
+        except Exception as e:
+            print(f"Warning: Could not preprocess image {image_path}, sending original: {e}")
+    
+    encoded = (image_type, base64.b64encode(raw_bytes).decode('utf-8'))
+    encoded_image_cache.set(raw_digest, encoded)
+    return encoded
+
+def batch_ocr_images(image_contents: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Group image parts into as few requests as the image-count and payload limits allow.
+    """
+    batches = [[]]
+    batch_bytes = 0
+    for image_content in image_contents:
+        image_bytes = len(image_content["image_url"]["url"])
+        if batches[-1] and (len(batches[-1]) >= OCR_MAX_IMAGES_PER_REQUEST or batch_bytes + image_bytes > OCR_MAX_PAYLOAD_BYTES):
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(image_content)
+        batch_bytes += image_bytes
+    return batches
+
+# Optionally prefetch PharmeEasy pages for medicines seen in the OCR stream, so the pages are cached by
+# the time FixMedications runs. Off by default: prefetches share the 1 req/s PharmeEasy rate limit with
+# the real lookups, and terms taken from raw OCR lines often differ from the extracted search terms
+PREFETCH_PHARMEASY_DURING_OCR = os.getenv("SHUSRUSHA_PREFETCH_PHARMEASY", "0") == "1"
+OCR_PREFETCH_LIMIT = 12
+OCR_FORM_NAMES = {"tab": "tablet", "cap": "capsule", "syp": "syrup", "syr": "syrup", "inj": "injection"}
+pharmeasy_prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pharmeasy-prefetch")
+
+def prefetch_pharmeasy_for_line(line: str, prefetched: set):
+    """
+    Start background PharmeEasy fetches for prescription lines like "Tab. Pantop 40 mg".
+    """
+    for match in _OCR_MEDICATION.finditer(line):
+        if len(prefetched) >= OCR_PREFETCH_LIMIT:
+            return
+        form_token, name, strength = match.groups()
+        search_term = pharmeasy_search_term({
+            "name": name,
+            "strength": strength or "",
+            "form": OCR_FORM_NAMES[form_token.lower()]
+        })
+        if search_term.lower() in prefetched:
+            continue
+        prefetched.add(search_term.lower())
+        pharmeasy_prefetch_executor.submit(fetch_pharmeasy_content, search_term)
+
+def transcribe_image_batch(client: openai.OpenAI, model: str, image_contents: List[Dict[str, Any]]) -> str:
+    """
+    Transcribe a batch of page images into markdown with a single vision request.
+    The response is streamed so PharmeEasy lookups can start while the rest is still generating.
+    """
+    messages = [
+        {"role": "system", "content": OCR_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Please transcribe these medical discharge summary pages into markdown format."}
+            ] + image_contents
+        }
+    ]
+    
+    api_params = get_openai_params(model, messages, max_tokens=4096, use_json_format=False)
+    if not PREFETCH_PHARMEASY_DURING_OCR:
+        response = create_chat_completion(client, api_params, use_cache=False)
+        return response.choices[0].message.content
+    
+    stream = create_chat_completion(client, {**api_params, "stream": True}, use_cache=False)
+    parts = []
+    pending_line = ""
+    prefetched = set()
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        parts.append(delta)
+        # Only scan complete lines, so a name split across chunks isn't searched half-written
+        *complete_lines, pending_line = (pending_line + delta).split("\n")
+        for line in complete_lines:
+            prefetch_pharmeasy_for_line(line, prefetched)
+    prefetch_pharmeasy_for_line(pending_line, prefetched)
+    return "".join(parts)
+
+def ocr_node(state: GraphState, model: str = "gpt-5.4", api_key: str = None) -> GraphState:
+    """
+    Process images and extract text using GPT-4 Vision.
+    """
+    client = get_openai_client(api_key)
+    
+    # Encode (and downscale) pages in parallel; Pillow releases the GIL while resampling
+    image_paths = state.get("images", [])
+    with ThreadPoolExecutor(max_workers=min(8, len(image_paths) or 1)) as executor:
+        encoded_images = list(executor.map(encode_image_for_ocr, image_paths))
+    
+    image_contents = []
+    seen_images = set()
+    for image_path, encoded in zip(image_paths, encoded_images):
+        if encoded is None:
             print(f"Warning: Image file not found: {image_path}")
             continue
+        # Identical pages (e.g. the same scan uploaded twice) are only sent once
+        image_digest = hashlib.sha256(encoded[1].encode('ascii')).digest()
+        if image_digest in seen_images:
+            print(f"Skipping duplicate page: {image_path}")
+            continue
+        seen_images.add(image_digest)
+        image_type, image_data = encoded
+        image_contents.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{image_type};base64,{image_data}"
+            }
+        })
     
     if not image_contents:
         markdown_text = "# OCR Error\nNo valid images found to process."
     else:
         try:
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Please transcribe these medical discharge summary pages into markdown format."}
-                    ] + image_contents
-                }
-            ]
-            
-            api_params = get_openai_params(model, messages, max_tokens=4096, use_json_format=False)
-            response = client.chat.completions.create(**api_params)
-            markdown_text = response.choices[0].message.content
+            batches = batch_ocr_images(image_contents)
+            if len(batches) == 1:
+                markdown_text = transcribe_image_batch(client, model, batches[0])
+            else:
+                # Oversized uploads are split into page batches transcribed concurrently, kept in page order
+                print(f"Splitting {len(image_contents)} pages into {len(batches)} OCR requests")
+                with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+                    futures = [executor.submit(transcribe_image_batch, client, model, batch) for batch in batches]
+                    markdown_text = "\n\n".join(future.result() for future in futures)
             
         except Exception as e:
             print(f"Error processing images with OpenAI API: {e}")
@@ -144,20 +678,17 @@ def extract_diagnoses_node(state: GraphState, model: str = "gpt-5.4", api_key: s
     """
     markdown_text = state.get("markdown", "")
     
-    system_prompt = """You are an expert medical doctor practising in Kolkata India. You have been given a hospital discharge report of a patient in simple mardown text format. Your job is to identify all the relevant medical terms in the document related to a) diagnosis names b) lab test names from the document. Ignore all medicine names. Keep in mind common terminology used in that part of the world. Return a JSON structure of the form
-{"diagnoses": ["diagnosis term 1", "diagnosis term 2", ...], "lab_tests":["lab test name 1", "lab test name 2", ...]}"""
-    
-    client = openai.OpenAI(api_key=api_key or os.getenv('OPENAI_API_KEY'))
+    client = get_openai_client(api_key)
     
     try:
         messages = [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": DIAGNOSES_SYSTEM_PROMPT},
             {"role": "user", "content": f"Please extract diagnoses and lab tests from this discharge summary:\n\n{markdown_text}"}
         ]
         
-        api_params = get_openai_params(model, messages, max_tokens=2048, use_json_format=True)
-        response = client.chat.completions.create(**api_params)
-        diagnoses_json = json.loads(response.choices[0].message.content)
+        api_params = get_openai_params(model, messages, max_tokens=2048, use_json_format=True, json_schema=DIAGNOSES_SCHEMA)
+        response = create_chat_completion(client, api_params, use_cache=False)
+        diagnoses_json = orjson.loads(response.choices[0].message.content)
         
     except Exception as e:
         print(f"Error extracting diagnoses with OpenAI API: {e}")
@@ -177,24 +708,17 @@ def extract_medications_node(state: GraphState, model: str = "gpt-5.4", api_key:
     """
     markdown_text = state.get("markdown", "")
     
-    system_prompt = """You are an expert medical doctor practising in Kolkata India. You have been given a hospital discharge report of a patient in simple mardown text format. Your job is to identify all the relevant medications from the document along with instructions. In case of difficulty identifying a medication, make sure the names match actual medications used in that part of the world. Return a JSON structure of the form
-{"medications": [{"name":"paracetamol xr", "form":"tablet", "strength":"5 mg", "instructions":"Twice daily", "duration":"continue"}, {"name":"atorvastatin", "form":"syrup", "strength":"10 ml", "instructions":"as needed", "duration":"as needed"}, {"name":"medicine_3", "form":"powder", "strength":"1 pouch", "instructions":"BID", "duration":"10 days"}]}.
-The "name" fields should only contain the medicine name e.g. "Rantac XR")
-and not contain other information like its strength or form factor (tab/table, cap/capsure, 
-syr/syrup, pdr/powder etc.). Finally append a small description to the instructions if they
-are not easily understandable by a layman"""
-
-    client = openai.OpenAI(api_key=api_key or os.getenv('OPENAI_API_KEY'))
+    client = get_openai_client(api_key)
     
     try:
         messages = [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": MEDICATIONS_SYSTEM_PROMPT},
             {"role": "user", "content": f"Please extract medications with instructions and duration from this discharge summary:\n\n{markdown_text}"}
         ]
         
-        api_params = get_openai_params(model, messages, max_tokens=2048, use_json_format=True)
-        response = client.chat.completions.create(**api_params)
-        medications_json = json.loads(response.choices[0].message.content)
+        api_params = get_openai_params(model, messages, max_tokens=2048, use_json_format=True, json_schema=MEDICATIONS_SCHEMA)
+        response = create_chat_completion(client, api_params, use_cache=False)
+        medications_json = orjson.loads(response.choices[0].message.content)
         
     except Exception as e:
         print(f"Error extracting medications with OpenAI API: {e}")
@@ -208,10 +732,55 @@ are not easily understandable by a layman"""
     state["medications"] = medications_json
     return state
 
+def extract_entities_node(state: GraphState, model: str = "gpt-5.4", api_key: str = None) -> GraphState:
+    """
+    Extract diagnoses, lab tests and medications with a single call, so the markdown is sent once.
+    Fills the same "diagnoses" and "medications" state fields as the two separate nodes.
+    """
+    markdown_text = state.get("markdown", "")
+    
+    client = get_openai_client(api_key)
+    
+    try:
+        messages = [
+            {"role": "system", "content": ENTITIES_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Please extract diagnoses, lab tests and medications with instructions and duration from this discharge summary:\n\n{markdown_text}"}
+        ]
+        
+        api_params = get_openai_params(model, messages, max_tokens=4096, use_json_format=True, json_schema=ENTITIES_SCHEMA)
+        response = create_chat_completion(client, api_params)
+        entities_json = orjson.loads(response.choices[0].message.content)
+        
+    except Exception as e:
+        print(f"Error extracting entities with OpenAI API: {e}")
+        entities_json = {}
+    
+    state["diagnoses"] = {
+        "diagnoses": entities_json.get("diagnoses", []),
+        "lab_tests": entities_json.get("lab_tests", [])
+    }
+    state["medications"] = {"medications": entities_json.get("medications", [])}
+    
+    # Print the entities output
+    print(f"=== Extract Entities Node Output (Model: {model}) ===")
+    print(state["diagnoses"])
+    print(state["medications"])
+    print("===================================================")
+    
+    return state
+
 def fetch_pharmeasy_content(medicine_name: str, max_retries: int = 3) -> str:
     """
     Fetch the HTML content from PharmeEasy search page with rate limiting and retry logic.
     """
+    cached_content = pharmeasy_content_cache.get(medicine_name)
+    if cached_content:
+        print(f"Using cached PharmeEasy content for {medicine_name}")
+        return cached_content
+    
+    # Per-request header overrides on top of the session headers
+    request_headers = {}
+    
     for attempt in range(max_retries):
         try:
             # Rate limiting to avoid being blocked
@@ -226,49 +795,37 @@ def fetch_pharmeasy_content(medicine_name: str, max_retries: int = 3) -> str:
             encoded_medicine = quote(medicine_name)
             search_url = f"https://pharmeasy.in/search/all?name={encoded_medicine}"
             
-            # Create a fresh session for each request to avoid connection issues
-            session = requests.Session()
-            
-            headers = {
-                'User-Agent': f'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'en-US,en;q=0.5',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-                'Cache-Control': 'no-cache',
-                'Pragma': 'no-cache'
-            }
-            session.headers.update(headers)
-            
             print(f"Fetching: {search_url} (attempt {attempt + 1})")
             
-            response = session.get(
+            # Per-thread session keeps connections to PharmeEasy alive across medications
+            response = get_pharmeasy_session().get(
                 search_url, 
-                timeout=20,  # Increased timeout
+                headers=request_headers,
+                timeout=(5, 20),  # Fail fast on connect, allow slow page loads
                 allow_redirects=True
             )
             
             # Check for rate limiting or blocking
             if response.status_code == 429:
+                pharmeasy_rate_limiter.on_throttle()
                 print(f"Rate limited for {medicine_name}, waiting before retry...")
                 time.sleep(5)
                 continue
             elif response.status_code == 403:
+                pharmeasy_rate_limiter.on_throttle()
                 print(f"Access forbidden for {medicine_name}, trying with different headers...")
                 # Try with different user agent
-                headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                session.headers.update(headers)
+                request_headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
                 continue
             
             response.raise_for_status()
+            pharmeasy_rate_limiter.on_success()
             
             content = response.text
             print(f"Successfully fetched {len(content)} characters from PharmeEasy for {medicine_name}")
             
-            # Close the session
-            session.close()
-            
+            if content:
+                pharmeasy_content_cache.set(medicine_name, content)
             return content
             
         except requests.exceptions.Timeout:
@@ -279,20 +836,37 @@ def fetch_pharmeasy_content(medicine_name: str, max_retries: int = 3) -> str:
             print(f"Request error for {medicine_name} (attempt {attempt + 1}): {e}")
         except Exception as e:
             print(f"Unexpected error fetching {medicine_name} (attempt {attempt + 1}): {e}")
-        
-        # Close session if it exists
-        try:
-            session.close()
-        except:
-            pass
     
     print(f"Failed to fetch content for {medicine_name} after {max_retries} attempts")
     return ""
 
-def parse_pharmeasy_products(html_content: str, model: str = "gpt-5.4", max_retries: int = 3, api_key: str = None) -> List[Dict[str, str]]:
+def absolute_pharmeasy_url(url: str) -> str:
+    """
+    Turn a relative PharmeEasy path into an absolute URL.
+    """
+    if url.startswith("/"):
+        return "https://pharmeasy.in" + url
+    elif not url.startswith("http") and url:
+        return "https://pharmeasy.in/" + url
+    return url
+
+def name_similarity_ratio(normalized_a: str, normalized_b: str) -> float:
+    """
+    Similarity in [0, 1] between two normalized names; containment counts as a full match.
+    """
+    if not normalized_a or not normalized_b:
+        return 0.0
+    if normalized_a in normalized_b or normalized_b in normalized_a:
+        return 1.0
+    if rapidfuzz_fuzz is not None:
+        return rapidfuzz_fuzz.ratio(normalized_a, normalized_b) / 100
+    return difflib.SequenceMatcher(None, normalized_a, normalized_b).ratio()
+
+def parse_pharmeasy_products(html_content: str, model: str = "gpt-5.4", max_retries: int = 3, api_key: str = None, medicine_name: str = None) -> List[Dict[str, str]]:
     """
-    Use LLM to parse Pharmeasy HTML and extract product listings with retry logic.
-    Also handles JSON data embedded in the page.
+    Extract product listings from a Pharmeasy search page.
+    Tries the embedded JSON first, then product links found in the HTML (ranked by name
+    similarity when medicine_name is given). The LLM is only used when neither finds anything.
     """
     
     # First, try to extract products from JSON data embedded in the page
@@ -301,153 +875,123 @@ def parse_pharmeasy_products(html_content: str, model: str = "gpt-5.4", max_retr
         print(f"Extracted {len(json_products)} products from embedded JSON data")
         return json_products
     
-    # Fallback to LLM parsing for HTML elements
-    for attempt in range(max_retries):
-        try:
-            # Rate limiting for OpenAI API
-            openai_rate_limiter.wait_if_needed()
-            
-            if attempt > 0:
-                print(f"Retrying OpenAI API call for HTML parsing (attempt {attempt + 1})")
-                time.sleep(random.uniform(0.5, 1.5))
-            
-            client = openai.OpenAI(api_key=api_key or os.getenv('OPENAI_API_KEY'))
+    # Then take product links straight from the HTML; only product-page hrefs are kept
+    candidates = extract_product_link_candidates(html_content)
+    if candidates:
+        print(f"Found {len(candidates)} product link candidates in HTML")
+        if medicine_name:
+            normalized_medicine = normalize_name_for_exact_match(medicine_name)
+            candidates = sorted(
+                candidates,
+                key=lambda candidate: name_similarity_ratio(normalized_medicine, normalize_name_for_exact_match(candidate[0])),
+                reverse=True
+            )
+        return [{"name": text, "url": absolute_pharmeasy_url(href)} for text, href in candidates[:10]]
+    
+    # Truncate content to manageable size
+    max_length = 15000
+    if len(html_content) > max_length:
+        # Keep beginning and middle sections which likely contain products
+        start_chunk = html_content[:5000]
+        middle_start = len(html_content) // 3
+        middle_chunk = html_content[middle_start:middle_start + 10000]
+        html_content = start_chunk + "\n... [content truncated] ...\n" + middle_chunk
+    
+    messages = [
+        {"role": "system", "content": HTML_PARSING_PROMPT},
+        {"role": "user", "content": f"Parse this PharmeEasy HTML and extract product listings:\n\n{html_content}"}
+    ]
+    
+    # Fallback to LLM parsing for HTML elements. Re-sending the same truncated page can't change
+    # the answer, so only transient API errors are retried (inside create_chat_completion)
+    try:
+        client = get_openai_client(api_key)
+        api_params = get_openai_params(model, messages, max_tokens=1024, use_json_format=True, json_schema=PRODUCT_LISTINGS_SCHEMA)
+        response = create_chat_completion(client, api_params, max_attempts=max_retries)
+        
+        result = orjson.loads(response.choices[0].message.content)
+        products = result.get("products", [])
+        
+        # Clean up URLs
+        cleaned_products = []
+        for product in products:
+            url = absolute_pharmeasy_url(product.get("url", ""))
+            name = product.get("name")
             
-            system_prompt = """You are an expert web scraper. Parse this HTML content from Pharmeasy.in search results.
-
-Look for product listings in the main body of the page and extract up to 10 products. For each product, extract:
-- name: The product name/title
-- url: The product URL (if relative path, prepend "https://pharmeasy.in")
-
-Look for patterns like:
-- Product cards or containers
-- Links to product pages (often containing "/online-medicine-order/" or "/medicines/")
-- Product names in headings, spans, or divs
-- Medicine names and dosages
-- JSON data containing product information
-
-Return JSON format:
-{"products": [{"name": "Product Name 1", "url": "https://pharmeasy.in/online-medicine-order/..."}, {"name": "Product Name 2", "url": "https://pharmeasy.in/..."}, ...]}
+            if name and url:
+                cleaned_products.append({
+                    "name": name,
+                    "url": url
+                })
+        
+        print(f"Extracted {len(cleaned_products)} products from Pharmeasy page")
+        return cleaned_products
+        
+    except Exception as e:
+        print(f"Failed to parse Pharmeasy HTML: {e}")
+        return []
 
-If no products found, return empty products array."""
-            
-            # Truncate content to manageable size
-            max_length = 15000
-            if len(html_content) > max_length:
-                # Keep beginning and middle sections which likely contain products
-                start_chunk = html_content[:5000]
-                middle_start = len(html_content) // 3
-                middle_chunk = html_content[middle_start:middle_start + 10000]
-                html_content = start_chunk + "\n... [content truncated] ...\n" + middle_chunk
-            
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Parse this PharmeEasy HTML and extract product listings:\n\n{html_content}"}
-            ]
-            
-            api_params = get_openai_params(model, messages, max_tokens=2048, use_json_format=True)
-            response = client.chat.completions.create(**api_params)
-            
-            result = json.loads(response.choices[0].message.content)
-            products = result.get("products", [])
-            
-            # Clean up URLs
-            cleaned_products = []
-            for product in products:
-                url = product.get("url", "")
-                if url.startswith("/"):
-                    url = "https://pharmeasy.in" + url
-                elif not url.startswith("http") and url:
-                    url = "https://pharmeasy.in/" + url
-                
-                if product.get("name") and url:
-                    cleaned_products.append({
-                        "name": product["name"],
-                        "url": url
-                    })
-            
-            print(f"Extracted {len(cleaned_products)} products from Pharmeasy page")
-            return cleaned_products
-            
-        except openai.RateLimitError:
-            print(f"OpenAI rate limit hit, waiting before retry (attempt {attempt + 1})")
-            time.sleep(2 ** attempt)  # Exponential backoff
-        except openai.APIError as e:
-            print(f"OpenAI API error in HTML parsing (attempt {attempt + 1}): {e}")
-            if attempt < max_retries - 1:
-                time.sleep(1)
-        except json.JSONDecodeError as e:
-            print(f"JSON decode error in HTML parsing (attempt {attempt + 1}): {e}")
-        except Exception as e:
-            print(f"Unexpected error in HTML parsing (attempt {attempt + 1}): {e}")
+def extract_product_link_candidates(html_content: str, max_candidates: int = 50) -> List[List[str]]:
+    """
+    Extract (link text, href) pairs that point at PharmeEasy product pages.
+    """
+    try:
+        soup = BeautifulSoup(html_content, "html.parser")
+    except Exception as e:
+        print(f"Error parsing HTML for product links: {e}")
+        return []
     
-    print(f"Failed to parse Pharmeasy HTML after {max_retries} attempts")
-    return []
+    candidates = []
+    seen_hrefs = set()
+    for anchor in soup.find_all("a", href=True):
+        href = anchor["href"]
+        if "/online-medicine-order/" not in href and "/medicines/" not in href:
+            continue
+        # Footer navigation ("Browse All Medicines/Cities") lives under the same path
+        if "/browse" in href:
+            continue
+        # Product cards wrap the name in a heading alongside brand, pack size and price text
+        heading = anchor.find(["h1", "h2", "h3", "h4"])
+        text = (heading or anchor).get_text(" ", strip=True)
+        if not text or href in seen_hrefs:
+            continue
+        seen_hrefs.add(href)
+        candidates.append([text, href])
+        if len(candidates) >= max_candidates:
+            break
+    
+    return candidates
+
+def extract_next_data_json(html_content: str) -> Any:
+    """
+    Return the parsed __NEXT_DATA__ script body, or None if the page has none or it isn't valid JSON.
+    """
+    script_tag = _NEXT_DATA_SCRIPT.search(html_content)
+    if not script_tag:
+        return None
+    end = html_content.find('</script>', script_tag.end())
+    if end == -1:
+        return None
+    try:
+        return orjson.loads(html_content[script_tag.end():end])
+    except orjson.JSONDecodeError:
+        return None
 
 def extract_json_products_from_html(html_content: str) -> List[Dict[str, str]]:
     """
     Extract product data from JSON embedded in PharmeEasy HTML.
     """
-    import json
-    import re
-    
     try:
-        # Look for JSON data in script tags or inline JSON
-        # PharmeEasy often embeds product data in __NEXT_DATA__ or similar structures
-        
-        # Pattern 1: Look for __NEXT_DATA__ JSON
-        next_data_pattern = r'__NEXT_DATA__["\']?\s*[=:]\s*({.*?})\s*(?:;|\n|</script>)'
-        matches = re.findall(next_data_pattern, html_content, re.DOTALL)
-        
-        for match in matches:
-            try:
-                data = json.loads(match)
-                products = extract_products_from_json(data)
-                if products:
-                    return products
-            except json.JSONDecodeError:
-                continue
-        
-        # Pattern 2: Look for product arrays directly in JSON
-        product_pattern = r'"products"\s*:\s*\[([^\]]*"name"[^\]]*)\]'
-        matches = re.findall(product_pattern, html_content, re.DOTALL)
-        
-        for match in matches:
-            try:
-                # Try to parse the products array
-                products_json = f'[{match}]'
-                products_data = json.loads(products_json)
-                
-                extracted_products = []
-                for product in products_data:
-                    if isinstance(product, dict) and 'name' in product:
-                        name = product.get('name', '')
-                        slug = product.get('slug', '')
-                        product_id = product.get('productId', '')
-                        
-                        # Construct URL
-                        if slug:
-                            url = f"https://pharmeasy.in/online-medicine-order/{slug}"
-                        elif product_id:
-                            url = f"https://pharmeasy.in/online-medicine-order?medicine_id={product_id}"
-                        else:
-                            continue
-                        
-                        if name and url:
-                            extracted_products.append({
-                                "name": name,
-                                "url": url
-                            })
-                
-                if extracted_products:
-                    return extracted_products[:10]  # Limit to 10 products
-                    
-            except json.JSONDecodeError:
-                continue
+        # PharmeEasy is a Next.js site: product data is embedded as JSON in <script id="__NEXT_DATA__">.
+        # Locate the tag and parse its whole body, so nested objects are handled correctly
+        next_data = extract_next_data_json(html_content)
+        if next_data is not None:
+            products = extract_products_from_json(next_data)
+            if products:
+                return products
         
-        # Pattern 3: Look for individual product objects with name and slug
-        individual_product_pattern = r'{[^}]*"name"\s*:\s*"([^"]*)"[^}]*"slug"\s*:\s*"([^"]*)"[^}]*}'
-        matches = re.findall(individual_product_pattern, html_content)
+        # Fallback: look for individual product objects with name and slug
+        matches = _PRODUCT_NAME_SLUG.findall(html_content)
         
         if matches:
             extracted_products = []
@@ -470,11 +1014,14 @@ def extract_json_products_from_html(html_content: str) -> List[Dict[str, str]]:
 
 def extract_products_from_json(data: dict) -> List[Dict[str, str]]:
     """
-    Recursively extract product information from nested JSON data.
+    Extract product information from nested JSON data.
+    Walks the tree depth-first with an explicit stack, in document order, and stops after 10 products.
     """
     products = []
+    stack = [data]
     
-    def find_products(obj, path=""):
+    while stack and len(products) < 10:
+        obj = stack.pop()
         if isinstance(obj, dict):
             # Check if this looks like a product object
             if 'name' in obj and 'slug' in obj:
@@ -493,133 +1040,189 @@ def extract_products_from_json(data: dict) -> List[Dict[str, str]]:
                         "url": url
                     })
             
-            # Continue searching in nested objects
-            for key, value in obj.items():
-                find_products(value, f"{path}.{key}" if path else key)
-                
+            # Push children reversed so they are visited in their original order
+            stack.extend(reversed(list(obj.values())))
         elif isinstance(obj, list):
-            for i, item in enumerate(obj):
-                find_products(item, f"{path}[{i}]" if path else f"[{i}]")
+            stack.extend(reversed(obj))
     
-    find_products(data)
-    return products[:10]  # Limit to 10 products
+    return products
 
-def wrap_medication_items_in_lists(html_content: str) -> str:
+def medication_list_item(name: str, pill_html: str) -> str:
     """
-    Find consecutive medication list items and wrap them in proper <ul> tags.
+    Markup for one medication with its pill, already wrapped in its own medication list.
     """
-    # Find all medication items
-    pattern = r'(<li class="medication-item">[^<]*(?:<[^>]*>[^<]*)*</li>)'
-    
-    def replace_with_list(match):
-        return f'<ul class="medication-list">{match.group(1)}</ul>'
+    return f'<ul class="medication-list"><li class="medication-item">{name} {pill_html}</li></ul>'
+
+# Inline medication pill, filled in with str.format_map by render_medication_pill
+_PILL_TEMPLATE = '''<span class="{pill_class}" title="{tooltip}">
+            <a href="{url}" target="_blank" style="text-decoration: none; color: inherit;">
+                💊 {display_names}{warning_icon}
+            </a>
+        </span>{confidence_indicator}'''
+
+@functools.lru_cache(maxsize=1024)
+def render_medication_pill(pill_class: str, tooltip_text: str, url: str, display_names: str, warning_icon: str, confidence: int) -> str:
+    """
+    Render the pill HTML, escaping the text fields, once per distinct pill.
+    """
+    confidence_indicator = f"<small style='color: #999; font-size: 0.7em;'> ({confidence}%)</small>" if confidence > 0 else ""
+    return _PILL_TEMPLATE.format_map({
+        "pill_class": pill_class,
+        "tooltip": escape(tooltip_text),
+        "url": escape(url),
+        "display_names": escape(display_names),
+        "warning_icon": warning_icon,
+        "confidence_indicator": confidence_indicator
+    })
+
+@functools.lru_cache(maxsize=1024)
+def whole_word_pattern(term: str) -> "re.Pattern":
+    """
+    Case-insensitive whole-word pattern for a medication name, compiled once per name.
+    """
+    return re.compile(r'\b' + re.escape(term) + r'\b', re.IGNORECASE)
+
+def build_medication_pill(medication: Dict[str, Any]) -> Tuple[str, bool]:
+    """
+    Build the pill HTML for one medication and report whether its name was changed.
+    """
+    original_name = medication.get("name", "")
+    pharmeasy_name = medication.get("pharmeasy_name", "")
+    url = medication.get("url", "")
+    confidence = medication.get("selection_confidence", 0)
+    modified_name = medication.get("modified_name", "")
+    selection_reasoning = medication.get("selection_reasoning", "")
+    reason = medication.get("reason", "")
+    
+    # Create tooltip based on selection reasoning or reason for change
+    tooltip_text = ""
+    if selection_reasoning:
+        tooltip_text = selection_reasoning
+    elif reason:
+        tooltip_text = reason
+    elif pharmeasy_name and pharmeasy_name != "Not found":
+        tooltip_text = f"Found matching product: {pharmeasy_name}"
+    else:
+        tooltip_text = f"Search for {original_name} on Pharmeasy"
     
-    # Replace single medication items with wrapped lists
-    html_content = re.sub(pattern, replace_with_list, html_content)
+    # Limit tooltip length
+    if len(tooltip_text) > 200:
+        tooltip_text = tooltip_text[:197] + "..."
     
-    # Merge consecutive medication lists
-    merge_pattern = r'</ul>\s*<ul class="medication-list">'
-    html_content = re.sub(merge_pattern, '', html_content)
+    # Check if name was modified - use multiple criteria
+    name_modified = False
+    display_names = original_name
     
-    return html_content
+    if pharmeasy_name and pharmeasy_name != "Not found":
+        # Check if it's actually a different product
+        original_lower = original_name.lower().strip()
+        pharmeasy_lower = pharmeasy_name.lower().strip()
+        
+        # Edit-distance similarity; one name containing the other counts as the same product
+        similarity = name_similarity_ratio(original_lower, pharmeasy_lower)
+        
+        # Consider it modified if similarity is low
+        if similarity < 0.7:
+            name_modified = True
+            # Show both names
+            display_names = f"{original_name} → {pharmeasy_name}"
+        elif modified_name and modified_name != original_name:
+            # Fallback to modified_name field
+            name_modified = True
+            display_names = f"{original_name} → {modified_name}"
+    
+    warning_icon = " ⚠" if name_modified else ""
+    
+    # Create smaller, more subtle pill HTML
+    pill_class = "medication-pill-modified" if name_modified else "medication-pill"
+    pill_html = render_medication_pill(pill_class, tooltip_text, url, display_names, warning_icon, confidence)
+    
+    return pill_html, name_modified
 
 def add_medication_pills_to_html(html_content: str, fixed_medications: Dict[str, Any], model: str = "gpt-5.4") -> str:
     """
     Add visual pills next to medications in the HTML content, converting to list items.
     """
     medications = fixed_medications.get("medications", [])
+    if not medications:
+        return html_content
     
+    # Skip the per-medication work entirely if no name (or name part) appears in the HTML
+    search_terms = set()
+    for medication in medications:
+        name = medication.get("name", "")
+        if name:
+            search_terms.add(name)
+            search_terms.update(part for part in name.split() if len(part) > 3)
+    if not search_terms:
+        return html_content
+    combined_pattern = re.compile("|".join(re.escape(term) for term in search_terms), re.IGNORECASE)
+    if not combined_pattern.search(html_content):
+        return html_content
+    
+    pills = []
+    pending_by_name = {}
     for medication in medications:
         original_name = medication.get("name", "")
-        pharmeasy_name = medication.get("pharmeasy_name", "")
-        url = medication.get("url", "")
-        confidence = medication.get("selection_confidence", 0)
-        modified_name = medication.get("modified_name", "")
-        selection_reasoning = medication.get("selection_reasoning", "")
-        reason = medication.get("reason", "")
-        
         if not original_name:
             continue
+        pill_html, name_modified = build_medication_pill(medication)
+        pill = {"name": original_name, "html": pill_html, "modified": name_modified, "placed": False}
+        pills.append(pill)
+        pending_by_name.setdefault(original_name.lower(), deque()).append(pill)
+    
+    # The document as (text, searchable) pieces: names are only matched in text between tags,
+    # never inside tag markup or inside the pills inserted by an earlier match
+    pieces = [(token, index % 2 == 0) for index, token in enumerate(_HTML_TAG.split(html_content))]
+    
+    def insert_items(pattern, make_item, count: int = 0) -> int:
+        """
+        Replace matches of pattern in the searchable pieces with make_item(match), skipping
+        matches for which it returns None. Stops after count insertions if count is set.
+        """
+        nonlocal pieces
+        inserted = 0
+        new_pieces = []
+        for text, searchable in pieces:
+            if not searchable or (count and inserted >= count):
+                new_pieces.append((text, searchable))
+                continue
+            last_end = 0
+            for match in pattern.finditer(text):
+                item = make_item(match)
+                if item is None:
+                    continue
+                new_pieces.append((text[last_end:match.start()], True))
+                new_pieces.append((item, False))
+                last_end = match.end()
+                inserted += 1
+                if count and inserted >= count:
+                    break
+            new_pieces.append((text[last_end:], True))
+        pieces = new_pieces
+        return inserted
+    
+    # Method 1: One pass over the HTML with every name as a whole-word alternative (longest first),
+    # giving each medication the first occurrence of its name not already taken
+    def insert_pill(match):
+        queue = pending_by_name.get(match.group(0).lower())
+        if not queue:
+            return None
+        pill = queue.popleft()
+        pill["placed"] = True
+        return medication_list_item(pill["name"], pill["html"])
+    
+    names = sorted({pill["name"] for pill in pills}, key=len, reverse=True)
+    all_names_pattern = re.compile(r'\b(?:' + "|".join(re.escape(name) for name in names) + r')\b', re.IGNORECASE)
+    insert_items(all_names_pattern, insert_pill)
+    
+    for pill in pills:
+        original_name = pill["name"]
+        pill_html = pill["html"]
+        replacements_made = 1 if pill["placed"] else 0
         
-        # Create tooltip based on selection reasoning or reason for change
-        tooltip_text = ""
-        if selection_reasoning:
-            tooltip_text = selection_reasoning
-        elif reason:
-            tooltip_text = reason
-        elif pharmeasy_name and pharmeasy_name != "Not found":
-            tooltip_text = f"Found matching product: {pharmeasy_name}"
-        else:
-            tooltip_text = f"Search for {original_name} on Pharmeasy"
-        
-        # Limit tooltip length
-        if len(tooltip_text) > 200:
-            tooltip_text = tooltip_text[:197] + "..."
-        
-        # Check if name was modified - use multiple criteria
-        name_modified = False
-        display_names = original_name
-        
-        if pharmeasy_name and pharmeasy_name != "Not found":
-            # Check if it's actually a different product
-            original_lower = original_name.lower().strip()
-            pharmeasy_lower = pharmeasy_name.lower().strip()
-            
-            # More sophisticated name comparison
-            # Consider it the same if one is contained in the other or very similar
-            is_subset = (original_lower in pharmeasy_lower or pharmeasy_lower in original_lower)
-            
-            # Calculate simple similarity (Levenshtein-like)
-            def simple_similarity(s1, s2):
-                if not s1 or not s2:
-                    return 0
-                longer = s1 if len(s1) > len(s2) else s2
-                shorter = s2 if len(s1) > len(s2) else s1
-                if len(longer) == 0:
-                    return 1.0
-                # Count matching characters in order
-                matches = 0
-                for i, char in enumerate(shorter):
-                    if i < len(longer) and char.lower() == longer[i].lower():
-                        matches += 1
-                return matches / len(longer)
-            
-            similarity = simple_similarity(original_lower, pharmeasy_lower)
-            
-            # Consider it modified if similarity is low AND not a subset match
-            if similarity < 0.7 and not is_subset:
-                name_modified = True
-                # Show both names
-                display_names = f"{original_name} → {pharmeasy_name}"
-            elif modified_name and modified_name != original_name:
-                # Fallback to modified_name field
-                name_modified = True
-                display_names = f"{original_name} → {modified_name}"
-        
-        warning_icon = " ⚠" if name_modified else ""
-        
-        # Create smaller, more subtle pill HTML
-        pill_class = "medication-pill-modified" if name_modified else "medication-pill"
-        confidence_indicator = f"<small style='color: #999; font-size: 0.7em;'> ({confidence}%)</small>" if confidence > 0 else ""
-        
-        pill_html = f'''<span class="{pill_class}" title="{tooltip_text}">
-            <a href="{url}" target="_blank" style="text-decoration: none; color: inherit;">
-                💊 {display_names}{warning_icon}
-            </a>
-        </span>{confidence_indicator}'''
-
-        # Find and replace medication name in HTML - convert to list item
-        replacements_made = 0
-        
-        # Method 1: Exact word boundary match
-        pattern1 = r'\b' + re.escape(original_name) + r'\b'
-        if re.search(pattern1, html_content, re.IGNORECASE):
-            # Replace with list item
-            html_content = re.sub(pattern1, f'<li class="medication-item">{original_name} {pill_html}</li>', html_content, count=1, flags=re.IGNORECASE)
-            replacements_made += 1
-        
-        # Method 2: If no exact match, try case-insensitive partial match
-        elif replacements_made == 0:
+        # Method 2: If no whole-word match, try case-insensitive partial match
+        if replacements_made == 0:
             # Look for the name in various forms
             search_variants = [
                 original_name,
@@ -629,13 +1232,10 @@ def add_medication_pills_to_html(html_content: str, fixed_medications: Dict[str,
             ]
             
             for variant in search_variants:
-                if variant in html_content:
-                    # Find the first occurrence and replace it
-                    pos = html_content.find(variant)
-                    if pos != -1:
-                        html_content = html_content[:pos] + f'<li class="medication-item">{variant} {pill_html}</li>' + html_content[pos + len(variant):]
-                        replacements_made += 1
-                        break
+                # Replace the first occurrence
+                replacements_made = insert_items(re.compile(re.escape(variant)), lambda _: medication_list_item(variant, pill_html), count=1)
+                if replacements_made:
+                    break
         
         # Method 3: If still no match, try to find partial matches
         if replacements_made == 0:
@@ -643,101 +1243,71 @@ def add_medication_pills_to_html(html_content: str, fixed_medications: Dict[str,
             name_parts = original_name.split()
             for part in name_parts:
                 if len(part) > 3:  # Only try meaningful parts
-                    pattern = r'\b' + re.escape(part) + r'\b'
-                    if re.search(pattern, html_content, re.IGNORECASE):
-                        html_content = re.sub(pattern, f'<li class="medication-item">{part} {pill_html}</li>', html_content, count=1, flags=re.IGNORECASE)
-                        replacements_made += 1
+                    replacements_made = insert_items(whole_word_pattern(part), lambda _: medication_list_item(part, pill_html), count=1)
+                    if replacements_made:
                         break
         
         # Debug output
         if replacements_made == 0:
             print(f"⚠️ Warning: Could not find medication '{original_name}' in HTML content")
         else:
-            print(f"✓ Added pill for: {original_name} ({'modified' if name_modified else 'exact'})")
+            print(f"✓ Added pill for: {original_name} ({'modified' if pill['modified'] else 'exact'})")
     
-    # After all medications are processed, wrap orphaned list items in proper lists
-    html_content = wrap_medication_items_in_lists(html_content)
+    html_content = "".join(text for text, _ in pieces)
     
-    return html_content
-
-def add_summary_pills_node(state: GraphState, model: str = "gpt-5.4", api_key: str = None) -> GraphState:
-    """
-    Generate enhanced HTML summary with inline medication pills as list items.
-    """
-    print(f"=== Add Summary Pills Node (Model: {model}) ===")
+    # Items were wrapped as they were inserted; merge neighbouring items into one list
+    html_content = _ADJACENT_MEDICATION_LISTS.sub('', html_content)
     
-    # Get data from state
-    markdown_text = state.get("markdown", "")
-    diagnoses = state.get("diagnoses", {})
-    fixed_medications = state.get("fixed_medications", {})
-    
-    # Convert markdown to HTML
-    print("Converting markdown to HTML...")
-    main_content_html = markdown_to_html(markdown_text)
-    
-    # Add medication pills to the HTML content
-    #print("Adding medication pills to content...")
-    #enhanced_html = add_medication_pills_to_html(main_content_html, fixed_medications, model)
-    enhanced_html = main_content_html
+    return html_content
 
-    # Generate medications summary table
-    print("Generating medications summary table...")
-    medications_table = generate_medications_table(fixed_medications)
-    
-    # Create complete HTML document with list-based medication display
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Medical Discharge Summary</title>
-        <meta charset="UTF-8">
-        <style>
-            body {{
+# Stylesheet for the summary report, inserted into the template once at import
+_SUMMARY_CSS = """
+            body {
                 font-family: Arial, sans-serif;
                 line-height: 1.6;
                 max-width: 1200px;
                 margin: 0 auto;
                 padding: 20px;
                 background-color: #f9f9f9;
-            }}
+            }
             
-            .main-content {{
+            .main-content {
                 background: white;
                 padding: 30px;
                 border-radius: 8px;
                 box-shadow: 0 2px 10px rgba(0,0,0,0.1);
                 margin-bottom: 30px;
-            }}
+            }
             
-            h1, h2, h3 {{
+            h1, h2, h3 {
                 color: #2c3e50;
                 border-bottom: 2px solid #3498db;
                 padding-bottom: 10px;
-            }}
+            }
             
-            .medication-list {{
+            .medication-list {
                 list-style-type: none;
                 padding-left: 0;
                 margin: 15px 0;
                 background: #f8f9fa;
                 border-left: 4px solid #007bff;
                 border-radius: 4px;
-            }}
+            }
             
-            .medication-item {{
+            .medication-item {
                 padding: 8px 15px;
                 margin: 0;
                 border-bottom: 1px solid #e9ecef;
                 display: flex;
                 align-items: center;
                 justify-content: space-between;
-            }}
+            }
             
-            .medication-item:last-child {{
+            .medication-item:last-child {
                 border-bottom: none;
-            }}
+            }
             
-            .medication-pill, .medication-pill-modified {{
+            .medication-pill, .medication-pill-modified {
                 display: inline-block;
                 background: rgba(76, 175, 80, 0.1);
                 border: 1px solid rgba(76, 175, 80, 0.3);
@@ -749,20 +1319,20 @@ def add_summary_pills_node(state: GraphState, model: str = "gpt-5.4", api_key: s
                 cursor: pointer;
                 transition: all 0.2s ease;
                 opacity: 0.8;
-            }}
+            }
             
-            .medication-pill-modified {{
+            .medication-pill-modified {
                 background: rgba(255, 152, 0, 0.1);
                 border-color: rgba(255, 152, 0, 0.3);
-            }}
+            }
             
-            .medication-pill:hover, .medication-pill-modified:hover {{
+            .medication-pill:hover, .medication-pill-modified:hover {
                 opacity: 1;
                 transform: scale(1.02);
                 box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            }}
+            }
             
-            .medications-summary {{
+            .medications-summary {
                 width: 100%;
                 border-collapse: collapse;
                 margin: 20px 0;
@@ -770,50 +1340,50 @@ def add_summary_pills_node(state: GraphState, model: str = "gpt-5.4", api_key: s
                 border-radius: 8px;
                 overflow: hidden;
                 box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-            }}
+            }
             
             .medications-summary th,
-            .medications-summary td {{
+            .medications-summary td {
                 padding: 12px;
                 text-align: left;
                 border-bottom: 1px solid #ddd;
-            }}
+            }
             
-            .medications-summary th {{
+            .medications-summary th {
                 background: linear-gradient(135deg, #3498db, #2980b9);
                 color: white;
                 font-weight: bold;
-            }}
+            }
             
-            .medications-summary tr:hover {{
+            .medications-summary tr:hover {
                 background-color: #f5f5f5;
-            }}
+            }
             
-            .confidence {{
+            .confidence {
                 font-weight: bold;
-            }}
+            }
             
-            .status-good {{ color: #27ae60; }}
-            .status-medium {{ color: #f39c12; }}
-            .status-low {{ color: #e74c3c; }}
-            .status-none {{ color: #95a5a6; }}
+            .status-good { color: #27ae60; }
+            .status-medium { color: #f39c12; }
+            .status-low { color: #e74c3c; }
+            .status-none { color: #95a5a6; }
             
-            .similarity-high {{ color: #27ae60; font-weight: bold; }}
-            .similarity-medium {{ color: #f39c12; font-weight: bold; }}
-            .similarity-low {{ color: #e74c3c; font-weight: bold; }}
+            .similarity-high { color: #27ae60; font-weight: bold; }
+            .similarity-medium { color: #f39c12; font-weight: bold; }
+            .similarity-low { color: #e74c3c; font-weight: bold; }
             
-            .category-exact {{ color: #27ae60; font-weight: bold; }}
-            .category-similar {{ color: #f39c12; font-weight: bold; }}
-            .category-different {{ color: #e74c3c; font-weight: bold; }}
+            .category-exact { color: #27ae60; font-weight: bold; }
+            .category-similar { color: #f39c12; font-weight: bold; }
+            .category-different { color: #e74c3c; font-weight: bold; }
             
-            .summary-section {{
+            .summary-section {
                 background: white;
                 padding: 30px;
                 border-radius: 8px;
                 box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-            }}
+            }
             
-            .diagnosis-pill {{
+            .diagnosis-pill {
                 display: inline-block;
                 background: linear-gradient(135deg, #ffebee, #ffcdd2);
                 border: 2px solid #f44336;
@@ -822,29 +1392,38 @@ def add_summary_pills_node(state: GraphState, model: str = "gpt-5.4", api_key: s
                 border-radius: 15px;
                 font-size: 14px;
                 font-weight: bold;
-            }}
+            }
             
-            .legend {{
+            .legend {
                 background: #ecf0f1;
                 padding: 15px;
                 border-radius: 5px;
                 margin: 20px 0;
-            }}
+            }
             
-            .legend h4 {{
+            .legend h4 {
                 margin-top: 0;
                 color: #2c3e50;
-            }}
+            }
             
-            .footer {{
+            .footer {
                 text-align: center;
                 margin-top: 30px;
                 padding: 20px;
                 background: #34495e;
                 color: white;
                 border-radius: 8px;
-            }}
-        </style>
+            }
+"""
+
+# HTML template for the summary report, filled in with str.format_map
+_SUMMARY_TEMPLATE = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Medical Discharge Summary</title>
+        <meta charset="UTF-8">
+        <style>{summary_css}        </style>
     </head>
     <body>
         <div class="main-content">
@@ -870,25 +1449,25 @@ def add_summary_pills_node(state: GraphState, model: str = "gpt-5.4", api_key: s
             <div style="display: grid; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)); gap: 15px; margin: 20px 0;">
                 <div style="background: #3498db; color: white; padding: 15px; border-radius: 8px; text-align: center;">
                     <h4>Total Medications</h4>
-                    <p style="font-size: 24px; margin: 0;">{len(fixed_medications.get("medications", []))}</p>
+                    <p style="font-size: 24px; margin: 0;">{total_medications}</p>
                 </div>
                 <div style="background: #27ae60; color: white; padding: 15px; border-radius: 8px; text-align: center;">
                     <h4>High Confidence Matches</h4>
-                    <p style="font-size: 24px; margin: 0;">{len([m for m in fixed_medications.get("medications", []) if m.get("selection_confidence", 0) > 80])}</p>
+                    <p style="font-size: 24px; margin: 0;">{high_confidence}</p>
                 </div>
                 <div style="background: #f39c12; color: white; padding: 15px; border-radius: 8px; text-align: center;">
                     <h4>Alternative Products</h4>
-                    <p style="font-size: 24px; margin: 0;">{len([m for m in fixed_medications.get("medications", []) if m.get("modified_name")])}</p>
+                    <p style="font-size: 24px; margin: 0;">{alternative_products}</p>
                 </div>
                 <div style="background: #e74c3c; color: white; padding: 15px; border-radius: 8px; text-align: center;">
                     <h4>No Matches Found</h4>
-                    <p style="font-size: 24px; margin: 0;">{len([m for m in fixed_medications.get("medications", []) if len(m.get("all_products", [])) == 0])}</p>
+                    <p style="font-size: 24px; margin: 0;">{no_matches}</p>
                 </div>
             </div>
             
             <h3>🏥 Diagnoses</h3>
             <div>
-                {"".join([f'<span class="diagnosis-pill">{d}</span>' for d in diagnoses.get("diagnoses", [])])}
+                {diagnoses_html}
             </div>
         </div>
         
@@ -899,52 +1478,134 @@ def add_summary_pills_node(state: GraphState, model: str = "gpt-5.4", api_key: s
     </body>
     </html>
     """
+
+# The summary template split around the medications table so the table can be streamed
+_SUMMARY_HEAD, _SUMMARY_TAIL = _SUMMARY_TEMPLATE.split("{medications_table}")
+# The head's only per-document field is the body, so the stylesheet and escapes are resolved once here
+_SUMMARY_HEAD_BEFORE_CONTENT, _SUMMARY_HEAD_AFTER_CONTENT = (part.format(summary_css=_SUMMARY_CSS) for part in _SUMMARY_HEAD.split("{enhanced_html}"))
+
+def write_html_summary(state: GraphState, fp, model: str = "gpt-5.4") -> Dict[str, int]:
+    """
+    Write the HTML summary document for the given state to the file-like object fp,
+    chunk by chunk, without building the whole document as one string first.
+    Returns the summary statistics that were rendered.
+    """
+    stats = {}
+    for part in iter_html_summary(state, model, stats):
+        fp.write(part)
+    return stats
+
+def iter_html_summary(state: GraphState, model: str = "gpt-5.4", stats: Dict[str, int] = None) -> Iterator[str]:
+    """
+    Yield the HTML summary document for the given state chunk by chunk.
+    If stats is given, it is filled with the summary statistics that were rendered.
+    """
+    # Get data from state
+    markdown_text = state.get("markdown", "")
+    diagnoses = state.get("diagnoses", {})
+    fixed_medications = state.get("fixed_medications", {})
+    
+    # Convert markdown to HTML
+    print("Converting markdown to HTML...")
+    main_content_html = markdown_to_html(markdown_text)
+    
+    # Add medication pills to the HTML content
+    #print("Adding medication pills to content...")
+    #enhanced_html = add_medication_pills_to_html(main_content_html, fixed_medications, model)
+    enhanced_html = main_content_html
+    
+    yield _SUMMARY_HEAD_BEFORE_CONTENT
+    yield enhanced_html
+    yield _SUMMARY_HEAD_AFTER_CONTENT
+    
+    # Stream the medications summary table
+    print("Generating medications summary table...")
+    yield from iter_medications_table(fixed_medications)
+    
+    # Count summary statistics in a single pass
+    medications = fixed_medications.get("medications", [])
+    high_confidence = alternative_products = no_matches = 0
+    for m in medications:
+        if m.get("selection_confidence", 0) > 80:
+            high_confidence += 1
+        if m.get("modified_name"):
+            alternative_products += 1
+        if not m.get("all_products"):
+            no_matches += 1
+    
+    counts = {
+        "total_medications": len(medications),
+        "high_confidence": high_confidence,
+        "alternative_products": alternative_products,
+        "no_matches": no_matches
+    }
+    if stats is not None:
+        stats.update(counts)
+    yield _SUMMARY_TAIL.format_map({
+        **counts,
+        "diagnoses_html": "".join(f'<span class="diagnosis-pill">{escape(d)}</span>' for d in diagnoses.get("diagnoses", ())),
+        "model": model
+    })
+
+def add_summary_pills_node(state: GraphState, model: str = "gpt-5.4", api_key: str = None) -> GraphState:
+    """
+    Generate enhanced HTML summary with inline medication pills as list items.
+    """
+    print(f"=== Add Summary Pills Node (Model: {model}) ===")
+    
+    # Create complete HTML document with list-based medication display
+    buffer = io.StringIO()
+    stats = write_html_summary(state, buffer, model)
     
     print("Enhanced HTML summary generated with:")
-    print(f"- {len(fixed_medications.get('medications', []))} medications processed")
-    print(f"- {len([m for m in fixed_medications.get('medications', []) if m.get('selection_confidence', 0) > 80])} high confidence matches")
+    print(f"- {stats['total_medications']} medications processed")
+    print(f"- {stats['high_confidence']} high confidence matches")
     print(f"- Medications displayed as list items")
     print(f"- Subtle inline pills and hover summaries added")
     print("=======================================")
     
-    state["html_summary"] = html_content
+    state["html_summary"] = buffer.getvalue()
     return state
 
+def add_summary_pills_node_stream(state: GraphState, model: str = "gpt-5.4", api_key: str = None) -> Iterator[str]:
+    """
+    Streaming variant of add_summary_pills_node: yields the HTML summary in chunks as it is
+    rendered. The state is not modified; callers join the chunks to get the full document.
+    """
+    print(f"=== Add Summary Pills Node, streaming (Model: {model}) ===")
+    yield from iter_html_summary(state, model)
+
 def markdown_to_html(markdown_text: str) -> str:
     """
     Convert markdown to HTML with basic formatting.
+    Uses mistune (single parse pass, handles lists and tables) when available.
     """
+    if _markdown_renderer is not None:
+        return _markdown_renderer(markdown_text)
+    
     # Basic markdown to HTML conversion
     html = markdown_text
     
     # Headers
-    html = re.sub(r'^# (.+)$', r'<h1>\1</h1>', html, flags=re.MULTILINE)
-    html = re.sub(r'^## (.+)$', r'<h2>\1</h2>', html, flags=re.MULTILINE)
-    html = re.sub(r'^### (.+)$', r'<h3>\1</h3>', html, flags=re.MULTILINE)
+    html = _MD_H1.sub(r'<h1>\1</h1>', html)
+    html = _MD_H2.sub(r'<h2>\1</h2>', html)
+    html = _MD_H3.sub(r'<h3>\1</h3>', html)
     
     # Bold and italic
-    html = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', html)
-    html = re.sub(r'\*(.+?)\*', r'<em>\1</em>', html)
+    html = _MD_BOLD.sub(r'<strong>\1</strong>', html)
+    html = _MD_ITALIC.sub(r'<em>\1</em>', html)
     
     # Line breaks and paragraphs
-    html = re.sub(r'\n\n+', '</p><p>', html)
+    html = _PARA.sub('</p><p>', html)
     html = f'<p>{html}</p>'
     
     # Clean up empty paragraphs
-    html = re.sub(r'<p>\s*</p>', '', html)
+    html = _EMPTY_P.sub('', html)
     
     return html
 
-def generate_medications_table(fixed_medications: Dict[str, Any]) -> str:
-    """
-    Generate HTML table summarizing the fix medications findings.
-    """
-    medications = fixed_medications.get("medications", [])
-    
-    if not medications:
-        return "<p>No medications found.</p>"
-    
-    table_html = """
+# Static header and footer of the medications summary table
+_TABLE_HEADER = """
     <table class="medications-summary">
         <thead>
             <tr>
@@ -959,6 +1620,37 @@ def generate_medications_table(fixed_medications: Dict[str, Any]) -> str:
         </thead>
         <tbody>
     """
+
+_TABLE_FOOTER = """
+        </tbody>
+    </table>
+    """
+
+# (status label, CSS class) indexed by tier: no match, low, medium, high confidence
+_STATUS_TIERS = (
+    ("❌ No match", "status-none"),
+    ("⚠️ Low confidence", "status-low"),
+    ("⚠️ Medium confidence", "status-medium"),
+    ("✅ High confidence", "status-good"),
+)
+
+def generate_medications_table(fixed_medications: Dict[str, Any]) -> str:
+    """
+    Generate HTML table summarizing the fix medications findings.
+    """
+    return "".join(iter_medications_table(fixed_medications))
+
+def iter_medications_table(fixed_medications: Dict[str, Any]) -> Iterator[str]:
+    """
+    Yield the HTML table summarizing the fix medications findings, one fragment at a time.
+    """
+    medications = fixed_medications.get("medications", [])
+    
+    if not medications:
+        yield "<p>No medications found.</p>"
+        return
+    
+    yield _TABLE_HEADER
     
     for medication in medications:
         original_name = medication.get("name", "")
@@ -970,18 +1662,8 @@ def generate_medications_table(fixed_medications: Dict[str, Any]) -> str:
         product_count = len(medication.get("all_products", []))
         
         # Determine status
-        if confidence > 80:
-            status = "✅ High confidence"
-            status_class = "status-good"
-        elif confidence > 50:
-            status = "⚠️ Medium confidence"
-            status_class = "status-medium"
-        elif product_count > 0:
-            status = "⚠️ Low confidence"
-            status_class = "status-low"
-        else:
-            status = "❌ No match"
-            status_class = "status-none"
+        tier = 3 if confidence > 80 else (2 if confidence > 50 else int(product_count > 0))
+        status, status_class = _STATUS_TIERS[tier]
         
         # Check if name was modified
         name_cell = pharmeasy_name
@@ -990,7 +1672,7 @@ def generate_medications_table(fixed_medications: Dict[str, Any]) -> str:
         
         url_cell = f'<a href="{url}" target="_blank">View</a>' if url else "N/A"
         
-        table_html += f"""
+        yield f"""
             <tr>
                 <td><strong>{original_name}</strong></td>
                 <td>{name_cell}</td>
@@ -1002,12 +1684,188 @@ def generate_medications_table(fixed_medications: Dict[str, Any]) -> str:
             </tr>
         """
     
-    table_html += """
-        </tbody>
-    </table>
+    yield _TABLE_FOOTER
+
+@functools.lru_cache(maxsize=8192)
+def normalize_name_for_exact_match(text: str) -> str:
+    """
+    Normalize text by removing non-alphabetic characters and converting to lowercase.
+    Unicode compatibility forms (full-width letters, ligatures, accents) are first folded to
+    their ASCII base letters so visually identical names normalize identically.
+    Memoized because the same catalog product names recur across medications and documents.
+    """
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').translate(None, _NON_ALPHA_BYTES).decode('ascii').lower()
+
+def extract_strength(text: str) -> str:
+    """
+    Extract numerical strength from text (e.g., '150mg' -> '150').
+    """
+    # Only the first strength is used, so stop scanning at the first match
+    match = _STRENGTH_WITH_UNIT.search(text)
+    return match.group(1) if match else ""
+
+# Common drug categories and packaging forms used for category similarity
+PRODUCT_CATEGORIES = ('tablet', 'syrup', 'capsule', 'injection', 'cream', 'ointment', 'drops', 'gel', 'powder', 'solution')
+PACKAGING_FORMS = ('strip', 'bottle', 'vial', 'tube', 'box', 'sachet', 'ampoule')
+
+def medicine_scoring_profile(medicine_name: str, medicine_strength: str, medication_details: Dict[str, Any] = None) -> Dict[str, Any]:
+    """
+    Everything calculate_hierarchical_score needs from the medicine side, computed once
+    so that scoring many candidate products only does the per-product work.
+    """
+    # Include medication details in the medicine text for better category matching
+    medicine_form = medication_details.get('form', '') if medication_details else ''
+    medicine_instructions = medication_details.get('instructions', '') if medication_details else ''
+    combined_medicine_text = f"{medicine_name} {medicine_form} {medicine_instructions}".lower()
+    
+    return {
+        "normalized_name": normalize_name_for_exact_match(medicine_name),
+        "strength": extract_strength(medicine_strength) if medicine_strength else "",
+        "words": set(medicine_name.lower().split()),
+        "categories": [cat for cat in PRODUCT_CATEGORIES if cat in combined_medicine_text],
+        "forms": [form for form in PACKAGING_FORMS if form in combined_medicine_text]
+    }
+
+def calculate_hierarchical_score(medicine_name: str, product_name: str, medicine_strength: str, product_text: str, medication_details: Dict[str, Any] = None, profile: Dict[str, Any] = None) -> tuple:
+    """
+    Calculate hierarchical score based on the specified priority order.
+    Returns (total_score, breakdown) where breakdown shows individual scores.
+    Pass the medicine_scoring_profile in when scoring several products for the same medicine.
+    """
+    if profile is None:
+        profile = medicine_scoring_profile(medicine_name, medicine_strength, medication_details)
+    
+    # Lowercase the product once; callers usually pass the product name as its text as well
+    product_name_lower = product_name.lower()
+    product_lower = product_name_lower if product_text == product_name else product_text.lower()
+    
+    # 1. EXACT NAME MATCH (40 points max)
+    normalized_medicine = profile["normalized_name"]
+    normalized_product = normalize_name_for_exact_match(product_name)
+    
+    exact_name_score = 0
+    if normalized_medicine in normalized_product or normalized_product in normalized_medicine:
+        exact_name_score = 40  # Full points for exact match
+    elif len(normalized_medicine) > 3 and len(normalized_product) > 3:
+        # Check for substantial overlap for very close matches (characters agreeing position by position)
+        shorter = normalized_medicine if len(normalized_medicine) < len(normalized_product) else normalized_product
+        longer = normalized_product if len(normalized_medicine) < len(normalized_product) else normalized_medicine
+        overlap_ratio = sum(map(operator.eq, shorter, longer)) / len(shorter)
+        if overlap_ratio > 0.8:
+            exact_name_score = 30  # High points for very close match
+    
+    # 2. STRENGTH MATCHING (30 points max)
+    strength_score = 0
+    extracted_medicine_strength = profile["strength"]
+    extracted_product_strength = extract_strength(product_text)
+    
+    if extracted_medicine_strength and extracted_product_strength:
+        try:
+            med_val = float(extracted_medicine_strength)
+            prod_val = float(extracted_product_strength)
+            if med_val == prod_val:
+                strength_score = 30  # Exact strength match
+            elif abs(med_val - prod_val) / max(med_val, prod_val) <= 0.1:  # Within 10%
+                strength_score = 20  # Close strength match
+            elif abs(med_val - prod_val) / max(med_val, prod_val) <= 0.5:  # Within 50%
+                strength_score = 10  # Partial strength match
+        except ValueError:
+            pass
+    elif not extracted_medicine_strength and extracted_product_strength:
+        strength_score = 15  # Some strength info is better than none
+    
+    # 3. NAME SIMILARITY (20 points max)
+    name_similarity_score = 0
+    # Simple similarity calculation
+    medicine_words = profile["words"]
+    product_words = set(product_name_lower.split())
+    
+    if medicine_words and product_words:
+        intersection = medicine_words.intersection(product_words)
+        union = medicine_words.union(product_words)
+        jaccard_similarity = len(intersection) / len(union) if union else 0
+        name_similarity_score = int(jaccard_similarity * 20)
+    
+    # 4. CATEGORY SIMILARITY (10 points max)
+    category_score = 0
+    
+    # Check the medicine's categories and forms (from its name and details) against the product text
+    if any(cat in product_lower for cat in profile["categories"]):
+        category_score += 5  # Same category
+    if any(form in product_lower for form in profile["forms"]):
+        category_score += 5  # Same form
+    
+    total_score = exact_name_score + strength_score + name_similarity_score + category_score
+    
+    breakdown = {
+        "exact_name": exact_name_score,
+        "strength": strength_score,
+        "name_similarity": name_similarity_score,
+        "category": category_score,
+        "total": total_score
+    }
+    
+    return total_score, breakdown
+
+def build_selection_analysis(breakdown: Dict[str, int], alternatives: List[int]) -> Dict[str, Any]:
+    """
+    Turn the selected product's hierarchical score breakdown into the selection analysis:
+    confidence percentage, reasoning text and categorical match ratings.
     """
+    # Bind the score components once
+    exact_name_points = breakdown["exact_name"]
+    strength_points = breakdown["strength"]
+    category_points = breakdown["category"]
+    
+    # Convert score to confidence percentage
+    max_possible_score = 100  # 40 + 30 + 20 + 10
+    confidence_percentage = min(100, int((breakdown["total"] / max_possible_score) * 100))
+    
+    # Ensure minimum confidence for exact name matches
+    if exact_name_points >= 30:  # Strong exact match
+        confidence_percentage = max(confidence_percentage, 85)
+    elif exact_name_points >= 20:  # Good exact match
+        confidence_percentage = max(confidence_percentage, 75)
+    
+    # Build detailed reasoning
+    reasoning_parts = []
+    
+    if exact_name_points >= 30:
+        reasoning_parts.append(f"Exact name match found ({exact_name_points}/40 points)")
+    elif exact_name_points > 0:
+        reasoning_parts.append(f"Partial name match ({exact_name_points}/40 points)")
+    else:
+        reasoning_parts.append("No exact name match (0/40 points)")
+    
+    if strength_points >= 25:
+        reasoning_parts.append(f"Exact strength match ({strength_points}/30 points)")
+    elif strength_points > 0:
+        reasoning_parts.append(f"Partial strength match ({strength_points}/30 points)")
+    else:
+        reasoning_parts.append("No strength match (0/30 points)")
+    
+    reasoning_parts.append(f"Name similarity: {breakdown['name_similarity']}/20 points")
+    reasoning_parts.append(f"Category similarity: {category_points}/10 points")
+    reasoning_parts.append(f"Total score: {breakdown['total']}/100")
+    
+    detailed_reasoning = ". ".join(reasoning_parts)
+    
+    # Determine categorical ratings
+    name_similarity = "high" if exact_name_points >= 30 else ("medium" if exact_name_points >= 10 else "low")
+    strength_match = "exact" if strength_points >= 25 else ("partial" if strength_points >= 10 else "none")
+    category_match = "exact" if category_points >= 8 else ("similar" if category_points >= 4 else "different")
     
-    return table_html
+    analysis = {
+        "confidence_score": confidence_percentage,
+        "reasoning": detailed_reasoning,
+        "name_similarity": name_similarity,
+        "strength_match": strength_match,
+        "form_match": "unknown",  # This could be enhanced if needed
+        "category_match": category_match,
+        "hierarchical_breakdown": breakdown,
+        "alternative_suggestions": alternatives
+    }
+    return analysis
 
 def select_best_product_match(medicine_name: str, products: List[Dict[str, str]], diagnoses: List[str], model: str = "gpt-5.4", max_retries: int = 3, medication_details: Dict[str, Any] = None, api_key: str = None) -> Dict[str, Any]:
     """
@@ -1017,114 +1875,62 @@ def select_best_product_match(medicine_name: str, products: List[Dict[str, str]]
     3. Name similarity
     4. Category similarity
     """
-    def normalize_name_for_exact_match(text: str) -> str:
-        """Normalize text by removing non-alphabetic characters and converting to lowercase."""
-        import re
-        return re.sub(r'[^a-zA-Z]', '', text).lower()
-
-    def extract_strength(text: str) -> str:
-        """Extract numerical strength from text (e.g., '150mg' -> '150')."""
-        import re
-        matches = re.findall(r'(\d+(?:\.\d+)?)\s*(?:mg|ml|g|mcg|units?|iu)', text.lower())
-        return matches[0] if matches else ""
-
-    def calculate_hierarchical_score(medicine_name: str, product_name: str, medicine_strength: str, product_text: str, medication_details: Dict[str, Any] = None) -> tuple:
-        """
-        Calculate hierarchical score based on the specified priority order.
-        Returns (total_score, breakdown) where breakdown shows individual scores.
-        """
-        
-        # 1. EXACT NAME MATCH (40 points max)
-        normalized_medicine = normalize_name_for_exact_match(medicine_name)
-        normalized_product = normalize_name_for_exact_match(product_name)
-        
-        exact_name_score = 0
-        if normalized_medicine in normalized_product or normalized_product in normalized_medicine:
-            exact_name_score = 40  # Full points for exact match
-        elif len(normalized_medicine) > 3 and len(normalized_product) > 3:
-            # Check for substantial overlap for very close matches
-            shorter = normalized_medicine if len(normalized_medicine) < len(normalized_product) else normalized_product
-            longer = normalized_product if len(normalized_medicine) < len(normalized_product) else normalized_medicine
-            overlap_ratio = sum(1 for i in range(len(shorter)) if i < len(longer) and shorter[i] == longer[i]) / len(shorter)
-            if overlap_ratio > 0.8:
-                exact_name_score = 30  # High points for very close match
-        
-        # 2. STRENGTH MATCHING (30 points max)
-        strength_score = 0
-        extracted_medicine_strength = extract_strength(medicine_strength) if medicine_strength else ""
-        extracted_product_strength = extract_strength(product_text)
-        
-        if extracted_medicine_strength and extracted_product_strength:
-            try:
-                med_val = float(extracted_medicine_strength)
-                prod_val = float(extracted_product_strength)
-                if med_val == prod_val:
-                    strength_score = 30  # Exact strength match
-                elif abs(med_val - prod_val) / max(med_val, prod_val) <= 0.1:  # Within 10%
-                    strength_score = 20  # Close strength match
-                elif abs(med_val - prod_val) / max(med_val, prod_val) <= 0.5:  # Within 50%
-                    strength_score = 10  # Partial strength match
-            except ValueError:
-                pass
-        elif not extracted_medicine_strength and extracted_product_strength:
-            strength_score = 15  # Some strength info is better than none
-        
-        # 3. NAME SIMILARITY (20 points max)
-        name_similarity_score = 0
-        # Simple similarity calculation
-        medicine_words = set(medicine_name.lower().split())
-        product_words = set(product_name.lower().split())
-        
-        if medicine_words and product_words:
-            intersection = medicine_words.intersection(product_words)
-            union = medicine_words.union(product_words)
-            jaccard_similarity = len(intersection) / len(union) if union else 0
-            name_similarity_score = int(jaccard_similarity * 20)
-        
-        # 4. CATEGORY SIMILARITY (10 points max)
-        category_score = 0
-        
-        # Check for common pharmaceutical terms in medicine name AND medication details
-        medicine_lower = medicine_name.lower()
-        product_lower = product_text.lower()
-        
-        # Include medication details in the medicine text for better category matching
-        medicine_form = medication_details.get('form', '') if medication_details else ''
-        medicine_instructions = medication_details.get('instructions', '') if medication_details else ''
-        
-        # Combine medicine name with available details for comprehensive matching
-        combined_medicine_text = f"{medicine_name} {medicine_form} {medicine_instructions}".lower()
-        
-        # Common drug categories and forms
-        categories = ['tablet', 'syrup', 'capsule', 'injection', 'cream', 'ointment', 'drops', 'gel', 'powder', 'solution']
-        forms = ['strip', 'bottle', 'vial', 'tube', 'box', 'sachet', 'ampoule']
-        
-        medicine_categories = [cat for cat in categories if cat in combined_medicine_text]
-        product_categories = [cat for cat in categories if cat in product_lower]
-        
-        medicine_forms = [form for form in forms if form in combined_medicine_text]
-        product_forms = [form for form in forms if form in product_lower]
-        
-        if set(medicine_categories).intersection(set(product_categories)):
-            category_score += 5  # Same category
-        if set(medicine_forms).intersection(set(product_forms)):
-            category_score += 5  # Same form
-        
-        total_score = exact_name_score + strength_score + name_similarity_score + category_score
-        
-        breakdown = {
-            "exact_name": exact_name_score,
-            "strength": strength_score,
-            "name_similarity": name_similarity_score,
-            "category": category_score,
-            "total": total_score
-        }
+    medicine_strength = medication_details.get('strength', '') if medication_details else ''
+    profile = medicine_scoring_profile(medicine_name, medicine_strength, medication_details)
+    normalized_medicine = profile["normalized_name"]
+    strength_value = profile["strength"]
+    
+    cache_key = make_cache_key(
+        normalized_medicine,
+        medicine_strength,
+        medication_details.get('form', '') if medication_details else '',
+        medication_details.get('instructions', '') if medication_details else '',
+        # Kept in order: alternative_suggestions are indices into this list
+        [f"{product['name']}|{product['url']}" for product in products],
+        model
+    )
+    cached_result = selection_cache.get(cache_key)
+    if cached_result is not None:
+        print(f"  🎯 Using cached selection for '{medicine_name}': {cached_result['product']['name']}")
+        return cached_result
+    
+    # Short-circuit: a single product whose normalized name contains the medicine name,
+    # and which agrees on strength and form, needs no ranking against the others
+    exact_matches = [
+        i for i, product in enumerate(products)
+        if normalized_medicine and normalized_medicine in normalize_name_for_exact_match(product['name'])
+    ]
+    if len(exact_matches) == 1:
+        product = products[exact_matches[0]]
+        product_lower = product['name'].lower()
+        # form may be None (JSON mode and schema-less models), as pharmeasy_search_term also allows
+        medicine_form = ((medication_details.get('form') if medication_details else '') or '').strip().lower()
+        strength_agrees = not strength_value or extract_strength(product['name']) == strength_value
+        form_agrees = not medicine_form or medicine_form in product_lower
         
-        return total_score, breakdown
-
+        if strength_agrees and form_agrees:
+            score, breakdown = calculate_hierarchical_score(
+                medicine_name,
+                product['name'],
+                medicine_strength,
+                product['name'],
+                medication_details,
+                profile
+            )
+            # Same analysis as the full ranking; the other products aren't scored, so no alternatives
+            analysis = build_selection_analysis(breakdown, [])
+            print(f"  🎯 Unique exact match for '{medicine_name}': {product['name']}")
+            
+            result = {
+                "product": product,
+                "analysis": analysis,
+                "success": True
+            }
+            selection_cache.set(cache_key, result)
+            return result
+    
     # Pre-analyze all products with hierarchical scoring
     product_scores = []
-    medicine_strength = medication_details.get('strength', '') if medication_details else ''
     
     for i, product in enumerate(products):
         score, breakdown = calculate_hierarchical_score(
@@ -1132,7 +1938,8 @@ def select_best_product_match(medicine_name: str, products: List[Dict[str, str]]
             product['name'], 
             medicine_strength, 
             product['name'],
-            medication_details
+            medication_details,
+            profile
         )
         product_scores.append({
             "index": i,
@@ -1141,8 +1948,8 @@ def select_best_product_match(medicine_name: str, products: List[Dict[str, str]]
             "product": product
         })
     
-    # Sort by score (highest first)
-    product_scores.sort(key=lambda x: x["score"], reverse=True)
+    # Only the best match and up to 3 alternatives are used, so keep just the top 4 (highest first)
+    product_scores = heapq.nlargest(4, product_scores, key=lambda x: x["score"])
     
     # Get the best match
     best_match = product_scores[0] if product_scores else None
@@ -1154,74 +1961,28 @@ def select_best_product_match(medicine_name: str, products: List[Dict[str, str]]
             "success": False
         }
     
-    # Convert score to confidence percentage
-    max_possible_score = 100  # 40 + 30 + 20 + 10
-    confidence_percentage = min(100, int((best_match["score"] / max_possible_score) * 100))
-    
-    # Ensure minimum confidence for exact name matches
-    if best_match["breakdown"]["exact_name"] >= 30:  # Strong exact match
-        confidence_percentage = max(confidence_percentage, 85)
-    elif best_match["breakdown"]["exact_name"] >= 20:  # Good exact match
-        confidence_percentage = max(confidence_percentage, 75)
-    
-    # Build detailed reasoning
-    breakdown = best_match["breakdown"]
-    reasoning_parts = []
-    
-    if breakdown["exact_name"] >= 30:
-        reasoning_parts.append(f"Exact name match found ({breakdown['exact_name']}/40 points)")
-    elif breakdown["exact_name"] > 0:
-        reasoning_parts.append(f"Partial name match ({breakdown['exact_name']}/40 points)")
-    else:
-        reasoning_parts.append("No exact name match (0/40 points)")
-    
-    if breakdown["strength"] >= 25:
-        reasoning_parts.append(f"Exact strength match ({breakdown['strength']}/30 points)")
-    elif breakdown["strength"] > 0:
-        reasoning_parts.append(f"Partial strength match ({breakdown['strength']}/30 points)")
-    else:
-        reasoning_parts.append("No strength match (0/30 points)")
-    
-    reasoning_parts.append(f"Name similarity: {breakdown['name_similarity']}/20 points")
-    reasoning_parts.append(f"Category similarity: {breakdown['category']}/10 points")
-    reasoning_parts.append(f"Total score: {breakdown['total']}/100")
-    
-    detailed_reasoning = ". ".join(reasoning_parts)
-    
-    # Determine categorical ratings
-    name_similarity = "high" if breakdown["exact_name"] >= 30 else ("medium" if breakdown["exact_name"] >= 10 else "low")
-    strength_match = "exact" if breakdown["strength"] >= 25 else ("partial" if breakdown["strength"] >= 10 else "none")
-    category_match = "exact" if breakdown["category"] >= 8 else ("similar" if breakdown["category"] >= 4 else "different")
-    
     # Get alternative suggestions (top 3 excluding the selected one)
     alternatives = [item["index"] for item in product_scores[1:4]]
-    
-    analysis = {
-        "confidence_score": confidence_percentage,
-        "reasoning": detailed_reasoning,
-        "name_similarity": name_similarity,
-        "strength_match": strength_match,
-        "form_match": "unknown",  # This could be enhanced if needed
-        "category_match": category_match,
-        "hierarchical_breakdown": breakdown,
-        "alternative_suggestions": alternatives
-    }
+    analysis = build_selection_analysis(best_match["breakdown"], alternatives)
+    confidence_percentage = analysis["confidence_score"]
+    breakdown = best_match["breakdown"]
     
     print(f"  🎯 Hierarchical Scoring for '{medicine_name}':")
     print(f"     Selected: {best_match['product']['name']}")
     print(f"     Score breakdown: {breakdown}")
     print(f"     Final confidence: {confidence_percentage}%")
     
-    return {
+    result = {
         "product": best_match["product"],
         "analysis": analysis,
         "success": True
     }
+    selection_cache.set(cache_key, result)
+    return result
 
-def process_single_medication(medication: Dict[str, Any], diagnoses_list: List[str], model: str, medication_index: int, api_key: str = None) -> Dict[str, Any]:
+def pharmeasy_search_term(medication: Dict[str, Any]) -> str:
     """
-    Process a single medication to find matching products on Pharmeasy.
-    This function is designed to be run in parallel.
+    Build the PharmeEasy search term for a medication: its name plus numeric strength and form.
     """
     base_medicine_name = medication.get('name', 'Unknown')
     
@@ -1229,11 +1990,10 @@ def process_single_medication(medication: Dict[str, Any], diagnoses_list: List[s
     search_terms = [base_medicine_name.strip()]
     
     # Extract numerical strength (e.g., "40mg", "5ml", "100")
-    strength = medication.get('strength', '').strip()
+    strength = (medication.get('strength') or '').strip()
     if strength:
         # Extract only the numerical part, exclude units (mg, ml, etc.)
-        import re
-        strength_match = re.search(r'(\d+\.?\d*)', strength.lower())
+        strength_match = _STRENGTH_NUM.search(strength)
         if strength_match:
             numerical_strength = strength_match.group(1)
             # Only add if it's not already in the medicine name and is meaningful
@@ -1241,28 +2001,66 @@ def process_single_medication(medication: Dict[str, Any], diagnoses_list: List[s
                 search_terms.append(numerical_strength)
     
     # Add form factor if available and not already in name
-    form = medication.get('form', '').strip()
+    form = (medication.get('form') or '').strip()
     if form and form.lower() not in base_medicine_name.lower():
         search_terms.append(form.lower())
     
     # Construct final search term
-    enhanced_medicine_name = ' '.join(search_terms)
+    return ' '.join(search_terms)
+
+def find_pharmeasy_products(search_name: str, medicine_name: str, model: str, api_key: str = None) -> Optional[List[Dict[str, str]]]:
+    """
+    Fetch and parse PharmeEasy search results, or return None if the page couldn't be fetched.
+    Non-empty results are kept on disk, so medicines seen on earlier runs skip the scrape.
+    Empty results are kept in memory for a few minutes, so a medicine PharmeEasy doesn't list
+    isn't re-parsed (possibly with an LLM call) on every document, but is retried later.
+    """
+    cache_key = make_cache_key(" ".join(search_name.lower().split()), medicine_name.lower()).hex()
+    cached_products = pharmeasy_products_disk_cache.get(cache_key)
+    if cached_products is not None:
+        print(f"Using disk-cached PharmeEasy products for {search_name}")
+        return orjson.loads(cached_products)
+    if pharmeasy_no_products_cache.get(cache_key):
+        print(f"No PharmeEasy products for {search_name} (cached)")
+        return []
+    
+    html_content = fetch_pharmeasy_content(search_name)
+    if not html_content:
+        return None
+    
+    products = parse_pharmeasy_products(html_content, model, api_key=api_key, medicine_name=medicine_name)
+    if products:
+        pharmeasy_products_disk_cache.set(cache_key, orjson.dumps(products).decode())
+    else:
+        pharmeasy_no_products_cache.set(cache_key, True)
+    return products
+
+def process_single_medication(medication: Dict[str, Any], diagnoses_list: List[str], model: str, medication_index: int, api_key: str = None, deadline: float = None) -> Dict[str, Any]:
+    """
+    Process a single medication to find matching products on Pharmeasy.
+    This function is designed to be run in parallel.
+    If the time.monotonic() deadline has passed once the products are fetched, the LLM selection is skipped.
+    """
+    base_medicine_name = medication.get('name', 'Unknown')
+    enhanced_medicine_name = pharmeasy_search_term(medication)
     
     print(f"\n🚀 STARTING: [{medication_index + 1}] {base_medicine_name}")
     if enhanced_medicine_name != base_medicine_name:
         print(f"   🔍 Enhanced search: '{enhanced_medicine_name}'")
     
     try:
-        # Fetch Pharmeasy page content using enhanced search term
-        html_content = fetch_pharmeasy_content(enhanced_medicine_name)
+        # Fetch and parse Pharmeasy products using enhanced search term
+        products = find_pharmeasy_products(enhanced_medicine_name, base_medicine_name, model, api_key=api_key)
+        
+        # The caller has stopped waiting for this result; free the worker instead of calling the LLM
+        if deadline is not None and time.monotonic() >= deadline:
+            print(f"⏱ Time budget exceeded, skipping product selection for {base_medicine_name}")
+            return medication_fallback_result(medication, "Time budget exceeded before product selection")
         
         # Create enhanced medication object
         medication_copy = medication.copy()
         
-        if html_content:
-            # Parse products from the HTML
-            products = parse_pharmeasy_products(html_content, model, api_key=api_key)
-            
+        if products is not None:
             if products:
                 print(f"Found {len(products)} products, selecting best match...")
                 
@@ -1359,15 +2157,49 @@ def process_single_medication(medication: Dict[str, Any], diagnoses_list: List[s
     except Exception as e:
         print(f"✗ Error processing {base_medicine_name}: {e}")  # Use original name for error message
         # Fallback for this medication
-        medication_copy = medication.copy()
         fallback_url = f"https://pharmeasy.in/search/all?name={base_medicine_name.replace(' ', '%20')}"  # Use original name for fallback
-        medication_copy.update({
+        return {
+            **medication,
             "url": fallback_url,
             "reason": f"Error during processing: {str(e)}",
             "all_products": [],
             "selection_confidence": 0
-        })
-        return medication_copy
+        }
+
+# Wall-clock budget in seconds for looking up all medications in fix_medications_node
+FIX_MEDICATIONS_TIME_BUDGET = 120
+
+# Long-lived lookup workers: each keeps its thread-local PharmeEasy session (and its open
+# connection) across runs instead of reconnecting for every document
+MEDICATION_LOOKUP_WORKERS = 5
+medication_lookup_executor = ThreadPoolExecutor(max_workers=MEDICATION_LOOKUP_WORKERS, thread_name_prefix="medication-lookup")
+
+def process_medication_with_fallback(medication: Dict[str, Any], diagnoses_list: List[str], model: str, medication_index: int, api_key: str = None, deadline: float = None) -> Tuple[Dict[str, Any], Optional[Exception]]:
+    """
+    Run process_single_medication, returning a fallback result and the error instead of raising.
+    Lookups that only start after the deadline are skipped.
+    """
+    if deadline is not None and time.monotonic() >= deadline:
+        return medication_fallback_result(medication, "Time budget exceeded before lookup started"), TimeoutError("time budget exceeded")
+    try:
+        return process_single_medication(medication, diagnoses_list, model, medication_index, api_key, deadline), None
+    except Exception as e:
+        return medication_fallback_result(medication, f"Parallel processing error: {str(e)}"), e
+
+def medication_fallback_result(medication: Dict[str, Any], reason: str) -> Dict[str, Any]:
+    """
+    Build a fallback result pointing at the PharmeEasy search page for a medication.
+    """
+    medicine_name = medication.get('name', 'Unknown')
+    fallback_url = f"https://pharmeasy.in/search/all?name={medicine_name.replace(' ', '%20')}"
+    return {
+        **medication,
+        "url": fallback_url,
+        "reason": reason,
+        "all_products": [],
+        "selection_confidence": 0,
+        "pharmeasy_name": "Error - fallback URL"
+    }
 
 def fix_medications_node(state: GraphState, model: str = "gpt-5.4", api_key: str = None) -> GraphState:
     """
@@ -1388,87 +2220,83 @@ def fix_medications_node(state: GraphState, model: str = "gpt-5.4", api_key: str
     print(f"\n=== Fix Medications Node - Parallel Processing (Model: {model}) ===")
     print(f"Processing {len(medications_list)} medications in parallel...")
     
+    # Deduplicate repeated medications so each distinct drug is looked up once
+    unique_medications = []
+    unique_index_by_key = {}
+    plan = []
+    for medication in medications_list:
+        key = (
+            " ".join(str(medication.get('name', '')).lower().split()),
+            str(medication.get('strength', '')).strip().lower(),
+            str(medication.get('form', '')).strip().lower()
+        )
+        if key not in unique_index_by_key:
+            unique_index_by_key[key] = len(unique_medications)
+            unique_medications.append(medication)
+        plan.append(unique_index_by_key[key])
+    
+    if len(unique_medications) < len(medications_list):
+        print(f"Deduplicated to {len(unique_medications)} unique medications")
+    
     # Use ThreadPoolExecutor for parallel processing
-    # Increased concurrency but with rate limiting to avoid overwhelming servers
-    max_workers = min(5, len(medications_list))  # Max 5 concurrent requests with rate limiting
-    fixed_medications_list = []
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all medication processing tasks with rate limiting
-        future_to_index = {}
-        future_to_medication = {}
-        
-        print(f"Submitting {len(medications_list)} medications with rate limiting (1 per second)...")
-        
-        for i, medication in enumerate(medications_list):
-            medicine_name = medication.get('name', f'Unknown_{i}')
-            
-            # Rate limiting: Start maximum 1 lookup per second
-            if i > 0:  # Don't delay the first submission
-                time.sleep(1.0)  # 1 second delay between submissions
-                print(f"⏱️ Rate limit delay: Starting medication {i+1} ({medicine_name})")
-            
-            future = executor.submit(
-                process_single_medication, 
-                medication, 
-                diagnoses_list, 
-                model, 
-                i,
-                api_key
-            )
-            future_to_index[future] = i
-            future_to_medication[future] = medicine_name
-        
+    # Concurrency is bounded here; request rates are bounded by the shared rate limiters
+    max_workers = min(MEDICATION_LOOKUP_WORKERS, len(unique_medications))  # Max 5 concurrent requests with rate limiting
+    unique_results = []
+    
+    failed_count = 0
+    
+    # Wall-clock budget for the whole stage, so one hanging lookup cannot stall the pipeline
+    deadline = time.monotonic() + FIX_MEDICATIONS_TIME_BUDGET
+    
+    # Submit all medication processing tasks up front; PharmeEasy and OpenAI
+    # rate limits are enforced by the shared limiters at each call site
+    print(f"Submitting {len(unique_medications)} medications...")
+    
+    futures = [
+        medication_lookup_executor.submit(process_medication_with_fallback, medication, diagnoses_list, model, i, api_key, deadline)
+        for i, medication in enumerate(unique_medications)
+    ]
+    try:
         # Print all medications that are now being processed in parallel
-        active_medications = list(future_to_medication.values())
-        print(f"\n🔄 PARALLEL PROCESSING STARTED - {len(active_medications)} medications:")
-        for i, med_name in enumerate(active_medications):
-            print(f"   [{i+1}] {med_name}")
-        print(f"   Using {max_workers} parallel workers with 1-second rate limiting\n")
-        
-        # Collect results as they complete
-        results = [None] * len(medications_list)  # Pre-allocate list to maintain order
-        completed_count = 0
-        failed_count = 0
+        print(f"\n🔄 PARALLEL PROCESSING STARTED - {len(unique_medications)} medications:")
+        for i, medication in enumerate(unique_medications):
+            print(f"   [{i+1}] {medication.get('name', f'Unknown_{i}')}")
+        print(f"   Using {max_workers} parallel workers with shared rate limiting\n")
         
-        for future in as_completed(future_to_index):
-            index = future_to_index[future]
+        # Collect results in submission order, waiting at most until the stage deadline
+        for completed_count, (medication, future) in enumerate(zip(unique_medications, futures), 1):
             try:
-                result = future.result(timeout=120)  # 2 minute timeout per medication
-                results[index] = result
-                completed_count += 1
-                
-                # Progress indicator
-                medicine_name = result.get('name', 'Unknown')
-                confidence = result.get('selection_confidence', 0)
-                product_count = len(result.get('all_products', []))
-                status = "✓" if product_count > 0 else "✗"
-                
-                if product_count > 0:
-                    print(f"[{completed_count}/{len(medications_list)}] {status} {medicine_name} - {confidence}% confidence ({product_count} products)")
-                else:
-                    print(f"[{completed_count}/{len(medications_list)}] {status} {medicine_name} - No products found")
-                
-            except Exception as e:
+                result, error = future.result(timeout=max(0, deadline - time.monotonic()))
+            except FuturesTimeoutError:
+                future.cancel()
+                result = medication_fallback_result(medication, f"Parallel processing error: timed out after {FIX_MEDICATIONS_TIME_BUDGET}s")
+                error = "timed out"
+            unique_results.append(result)
+            
+            if error:
                 failed_count += 1
-                print(f"✗ Error processing medication at index {index}: {e}")
-                # Create fallback result
-                original_medication = medications_list[index]
-                medicine_name = original_medication.get('name', 'Unknown')
-                fallback_url = f"https://pharmeasy.in/search/all?name={medicine_name.replace(' ', '%20')}"
-                fallback_result = original_medication.copy()
-                fallback_result.update({
-                    "url": fallback_url,
-                    "reason": f"Parallel processing error: {str(e)}",
-                    "all_products": [],
-                    "selection_confidence": 0,
-                    "pharmeasy_name": "Error - fallback URL"
-                })
-                results[index] = fallback_result
-                completed_count += 1
+                print(f"✗ Error processing medication at index {completed_count - 1}: {error}")
+                continue
+            
+            # Progress indicator
+            medicine_name = result.get('name', 'Unknown')
+            confidence = result.get('selection_confidence', 0)
+            product_count = len(result.get('all_products', []))
+            status = "✓" if product_count > 0 else "✗"
+            
+            if product_count > 0:
+                print(f"[{completed_count}/{len(unique_medications)}] {status} {medicine_name} - {confidence}% confidence ({product_count} products)")
+            else:
+                print(f"[{completed_count}/{len(unique_medications)}] {status} {medicine_name} - No products found")
+    finally:
+        # Drop lookups that never started. A running lookup can't be interrupted mid-request, but it
+        # checks the deadline after its PharmeEasy fetch and skips the LLM selection once it has passed
+        for future in futures:
+            future.cancel()
     
-    # Filter out any None results (shouldn't happen, but safety check)
-    fixed_medications_list = [result for result in results if result is not None]
+    # Fan results back out to every original position, keeping each entry's own fields
+    # (e.g. instructions/duration may differ between repeated listings)
+    fixed_medications_list = [{**unique_results[unique_index], **medication} for unique_index, medication in zip(plan, medications_list)]
     
     fixed_medications_json = {"medications": fixed_medications_list}
     
@@ -1478,25 +2306,37 @@ def fix_medications_node(state: GraphState, model: str = "gpt-5.4", api_key: str
     if failed_count > 0:
         print(f"⚠️ {failed_count} medications failed during processing and used fallback URLs")
     
-    # Summary statistics
-    successful_matches = sum(1 for med in fixed_medications_list if len(med.get('all_products', [])) > 0)
-    high_confidence = sum(1 for med in fixed_medications_list if med.get('selection_confidence', 0) > 80)
-    medium_confidence = sum(1 for med in fixed_medications_list if 50 <= med.get('selection_confidence', 0) <= 80)
-    fallback_urls = sum(1 for med in fixed_medications_list if 'fallback' in med.get('reason', '').lower() or 'error' in med.get('reason', '').lower())
+    # Summary statistics and per-medication details, collected in a single pass
+    successful_matches = high_confidence = medium_confidence = low_confidence = fallback_urls = 0
+    details = []
+    for med in fixed_medications_list:
+        product_count = len(med.get('all_products', []))
+        confidence = med.get('selection_confidence', 0)
+        reason = med.get('reason', '').lower()
+        is_fallback = 'fallback' in reason or 'error' in reason
+        
+        if product_count > 0:
+            successful_matches += 1
+        if confidence > 80:
+            high_confidence += 1
+        elif confidence >= 50:
+            medium_confidence += 1
+        else:
+            low_confidence += 1
+        if is_fallback:
+            fallback_urls += 1
+        
+        details.append((med.get('name'), med.get('pharmeasy_name', 'No match'), confidence, product_count, is_fallback))
     
     print(f"Results Summary:")
     print(f"- Successful matches: {successful_matches}/{len(fixed_medications_list)}")
     print(f"- High confidence (>80%): {high_confidence}")
     print(f"- Medium confidence (50-80%): {medium_confidence}")
-    print(f"- Low/No confidence: {len(fixed_medications_list) - high_confidence - medium_confidence}")
+    print(f"- Low/No confidence: {low_confidence}")
     print(f"- Fallback URLs (errors): {fallback_urls}")
     
     # Detailed per-medication summary
-    for med in fixed_medications_list:
-        product_count = len(med.get('all_products', []))
-        confidence = med.get('selection_confidence', 0)
-        is_fallback = 'fallback' in med.get('reason', '').lower() or 'error' in med.get('reason', '').lower()
-        
+    for name, pharmeasy_name, confidence, product_count, is_fallback in details:
         if is_fallback:
             status = "⚠"
             confidence_indicator = " (fallback)"
@@ -1504,8 +2344,7 @@ def fix_medications_node(state: GraphState, model: str = "gpt-5.4", api_key: str
             status = "✓" if product_count > 0 else "✗"
             confidence_indicator = f" ({confidence}%)" if confidence > 0 else ""
         
-        pharmeasy_name = med.get('pharmeasy_name', 'No match')
-        print(f"- {status} {med.get('name')} → {pharmeasy_name}{confidence_indicator}")
+        print(f"- {status} {name} → {pharmeasy_name}{confidence_indicator}")
     
     print("====================================")
     
@@ -1514,41 +2353,282 @@ def fix_medications_node(state: GraphState, model: str = "gpt-5.4", api_key: str
 
 # At the end of the file, add the app_graph instance
 class AppGraph:
-    def __init__(self):
+    # State fields each node reads, used to fingerprint its input for the response cache
+    NODE_INPUT_FIELDS = {
+        "ExtractDiagnoses": ("markdown",),
+        "ExtractMedications": ("markdown",),
+        "FixMedications": ("medications", "diagnoses"),
+        "AddSummaryPills": ("markdown", "diagnoses", "fixed_medications"),
+    }
+    
+    # node_name -> (node function, state field it produces)
+    NODES = {
+        "OCR": (ocr_node, "markdown"),
+        "ExtractDiagnoses": (extract_diagnoses_node, "diagnoses"),
+        "ExtractMedications": (extract_medications_node, "medications"),
+        "FixMedications": (fix_medications_node, "fixed_medications"),
+        "AddSummaryPills": (add_summary_pills_node, "html_summary"),
+    }
+    
+    # Default model per node, used when the caller doesn't pass one; mirrors the app's sidebar defaults
+    NODE_MODELS = {
+        "OCR": "gpt-5.4",
+        "ExtractDiagnoses": "gpt-5.4-mini",
+        "ExtractMedications": "gpt-5.4-mini",
+        "FixMedications": "gpt-5.4-mini",
+        # No LLM call; the model only appears in the report footer, which app.py left at run_node's old default
+        "AddSummaryPills": "gpt-5.4",
+    }
+    
+    # Nodes whose output doesn't depend on the markdown's line breaks or spacing
+    WHITESPACE_INSENSITIVE_NODES = ("ExtractDiagnoses", "ExtractMedications")
+    
+    # Per-node timing is recorded only when enabled, so the disabled cost is a single check
+    TELEMETRY = False
+    
+    def __init__(self, disk_cache_path: str = None):
         self.state = {}
+        # Shared by every session using this graph, so bounded; values are copied in and out
+        self.cache = TTLCache(maxsize=128, ttl=3600)
+        self.events = deque(maxlen=10000)
+        self.ocr_disk_cache = SQLiteCache(disk_cache_path or CACHE_DB_PATH, "ocr_results", ttl=OCR_DISK_CACHE_TTL) if PERSIST_OCR_RESULTS else None
+        self.warmed_api_keys = set()
     
-    def run_node(self, node_name: str, input_data=None, model: str = "gpt-5.4", api_key: str = None):
+    def warm_up(self, api_key: str = None):
         """
-        Run a specific node in the graph with the given input data.
+        Open the OpenAI connection in a background thread so the first node call doesn't pay
+        for client construction and the TCP/TLS handshake. Runs once per API key.
         """
-        if input_data is not None:
-            if node_name == "OCR":
-                self.state = ocr_node({"images": input_data}, model, api_key=api_key)
-                return self.state.get("markdown", "")
-            else:
-                # For other nodes, input_data might be used differently
-                pass
+        resolved_key = api_key or os.getenv('OPENAI_API_KEY')
+        if not resolved_key or resolved_key in self.warmed_api_keys:
+            return
+        self.warmed_api_keys.add(resolved_key)
+        
+        def ping():
+            try:
+                get_openai_client(api_key).models.list()
+            except Exception as e:
+                print(f"Warning: OpenAI warm-up failed: {e}")
+        
+        threading.Thread(target=ping, daemon=True).start()
+    
+    def clear_cache(self):
+        """
+        Drop all cached node outputs and cached OpenAI responses.
+        """
+        self.cache.clear()
+        chat_completion_cache.clear()
+    
+    def cache_key(self, node_name: str, state: Dict[str, Any], input_data, model: str) -> bytes:
+        """
+        Build a response-cache key from the node name, model and a hash of the node's input.
+        OCR inputs are hashed by image content so renamed temp files still hit the cache.
+        """
+        if node_name == "OCR":
+            return make_cache_key(node_name, model, self.image_hashes(input_data))
         
+        fields = self.NODE_INPUT_FIELDS.get(node_name, ())
+        values = [state.get(field) for field in fields]
+        # Whitespace-only differences in the OCR markdown shouldn't miss the extraction cache;
+        # the summary's layout depends on the newlines, so its key keeps them
+        if node_name in self.WHITESPACE_INSENSITIVE_NODES:
+            values = [" ".join(value.split()) if isinstance(value, str) else value for value in values]
+        return make_cache_key(node_name, model, values)
+    
+    def image_hashes(self, image_paths) -> List[str]:
+        """
+        Hash each image by content; unreadable paths fall back to the path itself.
+        """
+        image_hashes = []
+        for image_path in image_paths or []:
+            try:
+                with open(image_path, "rb") as image_file:
+                    image_hashes.append(hashlib.sha256(image_file.read()).hexdigest())
+            except OSError:
+                image_hashes.append(str(image_path))
+        return image_hashes
+    
+    def run_node(self, node_name: str, input_data=None, model: str = None, api_key: str = None, cache: bool = True):
+        """
+        Run a specific node in the graph with the given input data.
+        If model is None, the node's default from NODE_MODELS is used.
+        Single-user wrapper around run_node_with_state that keeps the state on self.state.
+        """
+        new_state, result = self.run_node_with_state(node_name, self.state, input_data, model, api_key, cache)
+        # Only the node's own output is written back, so nodes awaited together via run_node_async
+        # don't overwrite each other's fresh output with their stale copy of it
         if node_name == "OCR":
-            # Require input_data for OCR
-            if input_data is None:
-                raise ValueError("OCR node requires input_data (list of image paths)")
-            self.state = ocr_node({"images": input_data}, model, api_key=api_key)
-            return self.state.get("markdown", "")
-        elif node_name == "ExtractDiagnoses":
-            self.state = extract_diagnoses_node(self.state, model, api_key=api_key)
-            return self.state.get("diagnoses", {})
-        elif node_name == "ExtractMedications":
-            self.state = extract_medications_node(self.state, model, api_key=api_key)
-            return self.state.get("medications", {})
-        elif node_name == "FixMedications":
-            self.state = fix_medications_node(self.state, model, api_key=api_key)
-            return self.state.get("fixed_medications", {})
-        elif node_name == "AddSummaryPills":
-            self.state = add_summary_pills_node(self.state, model, api_key=api_key)
-            return self.state.get("html_summary", "")
+            self.state = new_state
         else:
+            self.state[self.NODES[node_name][1]] = result
+        return result
+    
+    def run_node_with_state(self, node_name: str, state: Dict[str, Any] = None, input_data=None, model: str = None, api_key: str = None, cache: bool = True) -> Tuple[Dict[str, Any], Any]:
+        """
+        Run a node against an explicit state and return (new_state, output).
+        The passed-in state is not modified, so concurrent requests can each keep their own.
+        Outputs are cached by (node, model, input hash) unless cache=False.
+        """
+        if node_name not in self.NODES:
+            raise ValueError(f"Unknown node: {node_name}")
+        if node_name == "OCR" and input_data is None:
+            raise ValueError("OCR node requires input_data (list of image paths)")
+        model = model or self.NODE_MODELS[node_name]
+        start_time = time.perf_counter()
+        
+        state = {"images": input_data} if node_name == "OCR" else dict(state or {})
+        output_field = self.NODES[node_name][1]
+        key = self.cache_key(node_name, state, input_data, model) if cache else None
+        
+        cached = self.cache.get(key) if key is not None else None
+        if cached is not None:
+            print(f"Using cached {node_name} output (Model: {model})")
+            result = copy.deepcopy(cached)
+            state[output_field] = result
+            if self.TELEMETRY:
+                self.record_event(node_name, model, start_time, "memory")
+            return state, result
+        
+        # OCR results also persist on disk, keyed by image content and model
+        images_hash = key.hex() if key is not None and node_name == "OCR" and self.ocr_disk_cache is not None else None
+        if images_hash is not None:
+            markdown = self.ocr_disk_cache.get(f"{model}:{images_hash}")
+            if markdown is not None:
+                print(f"Using disk-cached OCR output (Model: {model})")
+                self.cache.set(key, markdown)
+                state["markdown"] = markdown
+                if self.TELEMETRY:
+                    self.record_event(node_name, model, start_time, "disk")
+                return state, markdown
+        
+        new_state, result = self.execute_node(node_name, state, model, api_key)
+        
+        # Don't cache failed or empty outputs so they are retried next time
+        failed = node_name == "OCR" and str(result).startswith("# OCR Error")
+        empty = not result or (isinstance(result, dict) and not any(result.values()))
+        if key is not None and not failed and not empty:
+            self.cache.set(key, copy.deepcopy(result))
+            if images_hash is not None:
+                self.ocr_disk_cache.set(f"{model}:{images_hash}", result)
+        if self.TELEMETRY:
+            self.record_event(node_name, model, start_time, None)
+        return new_state, result
+    
+    def record_event(self, node_name: str, model: str, start_time: float, cache_hit: Optional[str]):
+        """
+        Append one node timing to self.events (bounded, oldest dropped first).
+        """
+        self.events.append({
+            "node": node_name,
+            "model": model,
+            "latency_ms": (time.perf_counter() - start_time) * 1000,
+            "cache_hit": cache_hit,
+            "timestamp": time.time(),
+        })
+    
+    def timings_df(self):
+        """
+        Return recorded node timings as a pandas DataFrame.
+        """
+        import pandas as pd
+        return pd.DataFrame(list(self.events), columns=["node", "model", "latency_ms", "cache_hit", "timestamp"])
+    
+    def execute_node(self, node_name: str, state: Dict[str, Any], model: str = None, api_key: str = None) -> Tuple[Dict[str, Any], Any]:
+        """
+        Run a node without consulting the response cache and return (new_state, output).
+        """
+        if node_name not in self.NODES:
             raise ValueError(f"Unknown node: {node_name}")
+        node_fn, output_field = self.NODES[node_name]
+        new_state = node_fn(state, model or self.NODE_MODELS[node_name], api_key=api_key)
+        # Text outputs default to "", JSON outputs to {}
+        default = "" if output_field in ("markdown", "html_summary") else {}
+        return new_state, new_state.get(output_field, default)
+    
+    async def run_node_async(self, node_name: str, input_data=None, model: str = None, api_key: str = None):
+        """
+        Async variant of run_node. The node runs in a worker thread, so independent nodes
+        (e.g. ExtractDiagnoses and ExtractMedications) can be awaited together with asyncio.gather.
+        """
+        return await asyncio.to_thread(self.run_node, node_name, input_data, model, api_key)
+
+    def run_node_stream(self, node_name: str, input_data=None, model: str = None, api_key: str = None, cache: bool = True) -> Iterator[str]:
+        """
+        Run a node and yield its text output in chunks as it is produced, e.g. for st.write_stream.
+        Only AddSummaryPills streams; self.state["html_summary"] is set once the last chunk is out.
+        """
+        if node_name != "AddSummaryPills":
+            raise ValueError(f"Streaming is not supported for node: {node_name}")
+        model = model or self.NODE_MODELS[node_name]
+        
+        key = self.cache_key(node_name, self.state, input_data, model) if cache else None
+        cached = self.cache.get(key) if key is not None else None
+        if cached is not None:
+            print(f"Using cached {node_name} output (Model: {model})")
+            self.state["html_summary"] = cached
+            yield cached
+            return
+        
+        self.state["html_summary"] = ""
+        parts = []
+        for part in add_summary_pills_node_stream(self.state, model, api_key=api_key):
+            parts.append(part)
+            yield part
+        html_summary = "".join(parts)
+        self.state["html_summary"] = html_summary
+        if key is not None and html_summary:
+            self.cache.set(key, html_summary)
+
+    def extract_in_parallel(self, state: Dict[str, Any], model: str = None, api_key: str = None) -> Dict[str, Any]:
+        """
+        Run ExtractDiagnoses and ExtractMedications concurrently on the same markdown and
+        return a new state with both outputs, taking max(t_diag, t_meds) instead of the sum.
+        """
+        # run_node_with_state copies the state, so the two threads never share a dict
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            diagnoses_future = executor.submit(self.run_node_with_state, "ExtractDiagnoses", state, None, model, api_key)
+            medications_future = executor.submit(self.run_node_with_state, "ExtractMedications", state, None, model, api_key)
+            _, diagnoses = diagnoses_future.result()
+            _, medications = medications_future.result()
+        
+        return {**state, "diagnoses": diagnoses, "medications": medications}
+    
+    def run_extractions(self, model: str = None, api_key: str = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Extract diagnoses and medications from self.state in parallel and return both.
+        """
+        self.state = self.extract_in_parallel(self.state, model, api_key)
+        return self.state["diagnoses"], self.state["medications"]
+    
+    async def run_extractions_async(self, model: str = None, api_key: str = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        Async variant of run_extractions, run in a worker thread.
+        """
+        return await asyncio.to_thread(self.run_extractions, model, api_key)
+    
+    def run_pipeline(self, images: List[str], model: str = None, api_key: str = None, combined_extraction: bool = False) -> GraphState:
+        """
+        Run OCR -> Extract -> Fix -> Summary in one call and return the final state.
+        Diagnoses and medications both only read the markdown, so they are extracted in parallel.
+        The state is local to this call, so several pipelines can run concurrently.
+        With combined_extraction=True, both are extracted by one call (extract_entities_node) instead.
+        Each step goes through run_node_with_state, so the response cache, OCR disk cache and telemetry apply.
+        """
+        state, _ = self.run_node_with_state("OCR", None, list(images), model, api_key)
+        if combined_extraction:
+            # The combined call isn't a registered node, so it is not cached
+            state = extract_entities_node(state, model or self.NODE_MODELS["ExtractMedications"], api_key=api_key)
+        else:
+            state = self.extract_in_parallel(state, model, api_key)
+        state, _ = self.run_node_with_state("FixMedications", state, None, model, api_key)
+        state, _ = self.run_node_with_state("AddSummaryPills", state, None, model, api_key)
+        return state
+
+    async def run_pipeline_async(self, images: List[str], model: str = None, api_key: str = None, combined_extraction: bool = False) -> GraphState:
+        """
+        Async variant of run_pipeline, run in a worker thread.
+        """
+        return await asyncio.to_thread(self.run_pipeline, images, model, api_key, combined_extraction)
 
 # Create the global app_graph instance
 app_graph = AppGraph()
\ No newline at end of file
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Behaviour tests for AppGraph caching and state handling, product selection and medication
+deduplication, using fake OpenAI and PharmeEasy responses (no network)
+"""
+
+import asyncio
+import contextlib
+import copy
+import io
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import langgraph_app
+from langgraph_app import AppGraph, calculate_hierarchical_score, build_selection_analysis, fix_medications_node, select_best_product_match
+
+class FakeOpenAIClient:
+    """Answers every chat completion with the next canned JSON reply and counts the calls"""
+    
+    def __init__(self, replies):
+        self.api_key = "test-key"
+        self.replies = list(replies)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+    
+    def create(self, **params):
+        reply = self.replies[min(self.calls, len(self.replies) - 1)]
+        self.calls += 1
+        message = SimpleNamespace(content=reply)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")])
+
+def make_graph(disk_cache_path=None):
+    """AppGraph whose OCR disk cache lives in a temporary directory"""
+    return AppGraph(disk_cache_path=disk_cache_path or os.path.join(tempfile.mkdtemp(), "cache.db"))
+
+def counting_node(output_field, value, calls):
+    """NODES entry for a fake node that sets output_field to a copy of value and records each call"""
+    def node(state, model, api_key=None):
+        calls.append(model)
+        state[output_field] = copy.deepcopy(value)
+        return state
+    return node, output_field
+
+def test_cached_outputs_are_copies():
+    """A cache hit skips the node, and mutating a returned output doesn't change the cache"""
+    calls = []
+    graph = make_graph()
+    graph.NODES = {**AppGraph.NODES, "ExtractMedications": counting_node("medications", {"medications": [{"name": "Pantop"}]}, calls)}
+    graph.state = {"markdown": "Tab Pantop 40"}
+    
+    first = graph.run_node("ExtractMedications")
+    first["medications"].append({"name": "Injected"})
+    second = graph.run_node("ExtractMedications")
+    
+    assert len(calls) == 1
+    assert second == {"medications": [{"name": "Pantop"}]}
+
+def test_ocr_results_persist_across_graphs():
+    """OCR output is reused from the disk cache by a new AppGraph, keyed by image content"""
+    directory = tempfile.mkdtemp()
+    image_path = os.path.join(directory, "page.jpg")
+    with open(image_path, "wb") as image_file:
+        image_file.write(b"not really a jpeg")
+    
+    calls = []
+    disk_cache_path = os.path.join(directory, "cache.db")
+    for _ in range(2):
+        graph = make_graph(disk_cache_path)
+        graph.NODES = {**AppGraph.NODES, "OCR": counting_node("markdown", "# Discharge Summary", calls)}
+        markdown = graph.run_node("OCR", [image_path])
+        assert markdown == "# Discharge Summary"
+    
+    assert len(calls) == (1 if langgraph_app.PERSIST_OCR_RESULTS else 2)
+
+def test_cache_bypass_calls_the_api_again():
+    """run_node(cache=False) must reach the API even after an identical cached call"""
+    client = FakeOpenAIClient(['{"diagnoses": ["OLD"], "lab_tests": []}', '{"diagnoses": ["NEW"], "lab_tests": []}'])
+    graph = make_graph()
+    graph.state = {"markdown": "Patient has GERD"}
+    
+    with mock.patch.object(langgraph_app, "get_openai_client", return_value=client):
+        first = graph.run_node("ExtractDiagnoses", model="gpt-5.4-mini")
+        cached = graph.run_node("ExtractDiagnoses", model="gpt-5.4-mini")
+        assert client.calls == 1
+        assert cached == first
+        
+        graph.clear_cache()
+        bypassed = graph.run_node("ExtractDiagnoses", model="gpt-5.4-mini", cache=False)
+    
+    assert client.calls == 2
+    assert bypassed["diagnoses"] == ["NEW"]
+
+def test_run_node_async_keeps_both_fresh_outputs():
+    """Nodes awaited together must not write back their stale copy of each other's output"""
+    def diagnoses_node(state, model, api_key=None):
+        time.sleep(0.05)
+        state["diagnoses"] = {"diagnoses": ["NEW"], "lab_tests": []}
+        return state
+    
+    def slow_medications_node(state, model, api_key=None):
+        time.sleep(0.2)
+        state["medications"] = {"medications": [{"name": "NEW"}]}
+        return state
+    
+    graph = make_graph()
+    graph.NODES = {
+        **AppGraph.NODES,
+        "ExtractDiagnoses": (diagnoses_node, "diagnoses"),
+        "ExtractMedications": (slow_medications_node, "medications"),
+    }
+    graph.state = {
+        "markdown": "Patient has GERD",
+        "diagnoses": {"diagnoses": ["OLD"], "lab_tests": []},
+        "medications": {"medications": [{"name": "OLD"}]},
+    }
+    
+    async def run_both():
+        await asyncio.gather(
+            graph.run_node_async("ExtractDiagnoses"),
+            graph.run_node_async("ExtractMedications"),
+        )
+    
+    asyncio.run(run_both())
+    
+    assert graph.state["diagnoses"]["diagnoses"] == ["NEW"]
+    assert graph.state["medications"]["medications"] == [{"name": "NEW"}]
+    assert graph.state["markdown"] == "Patient has GERD"
+
+def test_summary_cache_key_keeps_markdown_layout():
+    """Markdown differing only in whitespace shares an extraction key, but not a summary key"""
+    graph = make_graph()
+    structured = {"markdown": "# Title\n\nPara one\n\n## Meds\nx"}
+    flattened = {"markdown": "# Title Para one ## Meds x"}
+    
+    assert graph.cache_key("ExtractMedications", structured, None, "m") == graph.cache_key("ExtractMedications", flattened, None, "m")
+    assert graph.cache_key("AddSummaryPills", structured, None, "m") != graph.cache_key("AddSummaryPills", flattened, None, "m")
+
+def test_selection_allows_missing_form():
+    """A medication whose form is None (JSON mode, schema-less models) still gets its product"""
+    products = [
+        {"name": "Pantop 40mg Tablet", "url": "https://pharmeasy.in/online-medicine-order/pantop-40mg"},
+        {"name": "Pan 40mg Tablet", "url": "https://pharmeasy.in/online-medicine-order/pan-40mg"},
+    ]
+    medication = {"name": "Pantop", "strength": "40mg", "form": None, "instructions": None}
+    
+    result = select_best_product_match("Pantop", products, [], "gpt-5.4-mini", medication_details=medication)
+    
+    assert result["success"]
+    assert result["product"]["name"] == "Pantop 40mg Tablet"
+
+def test_unique_match_shortcut_agrees_with_full_ranking():
+    """When the unique-match shortcut applies, it picks the full ranking's best product with the same analysis"""
+    products = [
+        {"name": "Pan 40mg Tablet", "url": "https://pharmeasy.in/online-medicine-order/pan-40mg"},
+        {"name": "Rantac 150mg Strip Of 30 Tablets", "url": "https://pharmeasy.in/online-medicine-order/rantac-150mg"},
+        {"name": "Dolo 650mg Tablet", "url": "https://pharmeasy.in/online-medicine-order/dolo-650"},
+        {"name": "Pantop D Capsule", "url": "https://pharmeasy.in/online-medicine-order/pantop-d"},
+    ]
+    cases = [
+        ("Rantac", {"strength": "150mg", "form": "tablet", "instructions": "1 daily"}),
+        ("Dolo", {"strength": "650 mg", "form": "", "instructions": ""}),
+        ("Pantop D", {"strength": "", "form": "capsule", "instructions": "before food"}),
+    ]
+    
+    for medicine_name, medication_details in cases:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = select_best_product_match(medicine_name, products, [], "gpt-5.4-mini", medication_details=medication_details)
+        assert "Unique exact match" in output.getvalue()
+        
+        scores = [
+            calculate_hierarchical_score(medicine_name, product["name"], medication_details["strength"], product["name"], medication_details)
+            for product in products
+        ]
+        best_index = max(range(len(products)), key=lambda i: scores[i][0])
+        assert result["product"] == products[best_index]
+        assert result["analysis"] == build_selection_analysis(scores[best_index][1], [])
+
+def test_fix_medications_looks_up_repeated_medications_once():
+    """Repeated medications share one lookup, and each listing keeps its own fields"""
+    products = [{"name": "Pantop 40mg Tablet", "url": "https://pharmeasy.in/online-medicine-order/pantop-40mg"}]
+    searches = []
+    
+    def fake_find_products(search_term, medicine_name, model, api_key=None):
+        searches.append(search_term)
+        return products
+    
+    medications = [
+        {"name": "Pantop", "strength": "40mg", "form": "tablet", "instructions": "before breakfast"},
+        {"name": "pantop", "strength": "40mg ", "form": "Tablet", "instructions": "before dinner"},
+        {"name": "Dolo", "strength": "650mg", "form": "tablet", "instructions": "if fever"},
+    ]
+    state = {"medications": {"medications": medications}, "diagnoses": {"diagnoses": ["GERD"], "lab_tests": []}}
+    
+    with mock.patch.object(langgraph_app, "find_pharmeasy_products", side_effect=fake_find_products):
+        fixed = fix_medications_node(state, "gpt-5.4-mini")["fixed_medications"]["medications"]
+    
+    assert len(searches) == 2
+    assert [medication["instructions"] for medication in fixed] == ["before breakfast", "before dinner", "if fever"]
+    assert [medication["name"] for medication in fixed] == ["Pantop", "pantop", "Dolo"]
+    assert fixed[0]["url"] == fixed[1]["url"] == products[0]["url"]
+
+if __name__ == "__main__":
+    test_cached_outputs_are_copies()
+    test_ocr_results_persist_across_graphs()
+    test_cache_bypass_calls_the_api_again()
+    test_run_node_async_keeps_both_fresh_outputs()
+    test_summary_cache_key_keeps_markdown_layout()
+    test_selection_allows_missing_form()
+    test_unique_match_shortcut_agrees_with_full_ranking()
+    test_fix_medications_looks_up_repeated_medications_once()
+    print("✅ AppGraph tests passed")